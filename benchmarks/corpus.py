@@ -0,0 +1,88 @@
+import logging
+from itertools import combinations_with_replacement
+from pathlib import Path
+
+import numpy as np
+from isimip_utils.netcdf import init_dataset
+
+logger = logging.getLogger(__name__)
+
+LON = 72
+LAT = 36
+
+
+def get_enum(schema, identifier):
+    properties = schema['properties']['specifiers']['properties'][identifier]
+    if 'enum' in properties:
+        return properties['enum']
+    elif 'const' in properties:
+        return [properties['const']]
+
+
+def get_years(schema):
+    properties = schema['properties']['specifiers']['properties']['start_year']
+    return list(combinations_with_replacement(range(properties['minimum'], properties['maximum'] + 1), 2))
+
+
+def get_file_names(pattern, schema, datasets, files):
+    # the names follow the file pattern of the testing protocol, the values
+    # are taken from the enums in the schema, so that validation passes
+    alphas = get_enum(schema, 'alpha')
+    beta, gamma, delta = get_enum(schema, 'beta')[0], get_enum(schema, 'gamma')[0], get_enum(schema, 'delta')[0]
+    variable, region, timestep = get_enum(schema, 'variable')[0], get_enum(schema, 'region')[0], \
+        get_enum(schema, 'timestep')[0]
+
+    years = get_years(schema)
+    if files > len(years):
+        raise RuntimeError(f'The schema only allows {len(years)} files per dataset')
+
+    for i in range(datasets):
+        modelname = f'model{i // len(alphas)}'
+        alpha = alphas[i % len(alphas)]
+        for start_year, end_year in years[:files]:
+            name = f'{modelname}_{alpha}_{beta}_{gamma}_{delta}_{variable}_{region}_{timestep}' \
+                   f'_{start_year}_{end_year}.nc'
+            if not pattern['file'].search(name):
+                raise RuntimeError(f'{name} does not match the file pattern')
+            yield modelname, name
+
+
+def get_attrs(variables, attributes, attribute_length, nan_fraction):
+    # numeric attribute arrays can contain a share of NaN values to exercise clean_header
+    array = np.linspace(0, 1, attribute_length)
+    array[:int(attribute_length * nan_fraction)] = np.nan
+
+    attrs = {
+        'global': {f'attribute_{j}': f'value {j}' for j in range(attributes)}
+    }
+    for k in range(variables):
+        attrs[f'var{k}'] = {
+            'standard_name': f'var{k}',
+            'units': '1',
+            **{f'attribute_{j}': array for j in range(attributes)}
+        }
+    return attrs
+
+
+def generate_corpus(base_path, path, pattern, schema, datasets=10, files=3, size=LON * LAT * 4,
+                    variables=1, attributes=2, attribute_length=10, nan_fraction=0, seed=42):
+    # random data, since the data variables are zlib compressed
+    rng = np.random.default_rng(seed)
+    time = np.arange(max(1, size // (LON * LAT * 4 * variables)), dtype='f8')
+    attrs = get_attrs(variables, attributes, attribute_length, nan_fraction)
+    data = {
+        f'var{k}': rng.random((len(time), LAT, LON), dtype='f4') for k in range(variables)
+    }
+
+    file_paths = []
+    for directory, name in get_file_names(pattern, schema, datasets, files):
+        file_path = Path(base_path) / path / directory / name
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+
+        logger.debug('generate %s', file_path)
+        dataset = init_dataset(file_path, overwrite=True, lon=LON, lat=LAT, time=time, attrs=attrs, **data)
+        dataset.close()
+
+        file_paths.append(file_path)
+
+    return file_paths
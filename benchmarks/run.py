@@ -0,0 +1,221 @@
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from isimip_utils.checksum import get_checksum
+from isimip_utils.cli import parse_locations
+from isimip_utils.protocol import fetch_pattern, fetch_schema, fetch_tree
+from sqlalchemy import delete
+
+from isimip_publisher import VERSION
+from isimip_publisher.utils import database, files, patterns, validation
+from isimip_publisher.utils.files import clean_header, read_netcdf_header
+
+from .corpus import generate_corpus
+
+BASE_PATH = Path(__file__).parent.parent
+BENCHMARK_PATH = 'round/product/sector'
+BENCHMARK_VERSION = '19700101'
+
+
+def measure(func, repeat):
+    # run func repeat times and return the timings and the result of the last run
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def get_result(timings, count):
+    return {
+        'count': count,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'max': max(timings),
+        'per_item': min(timings) / count if count else None,
+        'timings': timings
+    }
+
+
+def run_benchmarks(base_path, pattern, schema, tree, repeat=3, database_settings=None):
+    results = {}
+
+    timings, file_list = measure(lambda: files.list_files(base_path, BENCHMARK_PATH), repeat)
+    results['list_files'] = get_result(timings, len(file_list))
+
+    timings, datasets = measure(lambda: patterns.match_datasets(pattern, base_path, file_list), repeat)
+    results['match_datasets'] = get_result(timings, len(file_list))
+
+    file_objects = [file for dataset in datasets for file in dataset.files]
+
+    def validate():
+        for dataset in datasets:
+            dataset.clean = False
+            for file in dataset.files:
+                file.clean = False
+        validation.validate_datasets(schema, BENCHMARK_PATH, datasets)
+
+    timings, _ = measure(validate, repeat)
+    results['validate_datasets'] = get_result(timings, len(file_objects))
+
+    # call the functions behind the properties, so that every run does the actual work
+    timings, headers = measure(lambda: [read_netcdf_header(file.abspath) for file in file_objects], repeat)
+    results['netcdf_header'] = get_result(timings, len(file_objects))
+    for file, header in zip(file_objects, headers, strict=True):
+        file.netcdf_header = header
+
+    timings, _ = measure(lambda: [clean_header(header) for header in headers], repeat)
+    results['clean_header'] = get_result(timings, len(file_objects))
+
+    timings, _ = measure(lambda: [get_checksum(file.abspath, file.checksum_type) for file in file_objects], repeat)
+    results['checksum'] = get_result(timings, len(file_objects))
+
+    def build_tree():
+        tree_dict = {}
+        for dataset in datasets:
+            database.build_tree_dict(tree_dict, Path(), tree['identifiers'], dataset.specifiers)
+
+    timings, _ = measure(build_tree, repeat)
+    results['build_tree_dict'] = get_result(timings, len(datasets))
+
+    if database_settings:
+        results.update(run_database_benchmarks(database_settings, datasets, file_objects))
+
+    return results
+
+
+def run_database_benchmarks(database_settings, datasets, file_objects):
+    results = {}
+    session = database.init_database_session(database_settings)
+
+    # warm the properties, so that only the database is measured
+    for file in file_objects:
+        file.cleaned_header  # noqa: B018
+        file.checksum  # noqa: B018
+
+    def insert():
+        for dataset in datasets:
+            db_dataset = database.insert_dataset(session, BENCHMARK_VERSION, None, False,
+                                                 dataset.name, dataset.path, dataset.size, dataset.specifiers)
+            database.insert_files(session, BENCHMARK_VERSION, db_dataset, dataset.files)
+            session.commit()
+
+    try:
+        clean_database(session)
+
+        # the first run inserts the rows, the second run checks the existing rows
+        timings, _ = measure(insert, 1)
+        results['insert_datasets'] = get_result(timings, len(file_objects))
+
+        timings, _ = measure(insert, 1)
+        results['reinsert_datasets'] = get_result(timings, len(file_objects))
+    finally:
+        clean_database(session)
+        session.close()
+
+    return results
+
+
+def clean_database(session):
+    # remove only the rows which were created by the benchmark
+    session.rollback()
+    session.execute(delete(database.File).where(database.File.version == BENCHMARK_VERSION))
+    session.execute(delete(database.Dataset).where(database.Dataset.version == BENCHMARK_VERSION))
+    session.commit()
+
+
+def compare_results(results, baseline):
+    print(f'{"stage":<20} {"baseline":>12} {"current":>12} {"ratio":>8}')
+    for stage, result in results['results'].items():
+        if stage in baseline['results']:
+            baseline_min = baseline['results'][stage]['min']
+            ratio = result['min'] / baseline_min if baseline_min else float('nan')
+            print(f'{stage:<20} {baseline_min:>12.6f} {result["min"]:>12.6f} {ratio:>8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run',
+                                     description='Benchmark the publisher pipeline on a synthetic corpus.')
+    parser.add_argument('--datasets', type=int, default=10,
+                        help='Number of datasets to generate [default: 10]')
+    parser.add_argument('--files', type=int, default=3,
+                        help='Number of files per dataset [default: 3]')
+    parser.add_argument('--size', type=int, default=10000,
+                        help='Approximate size of the data in each file in bytes [default: 10000]')
+    parser.add_argument('--variables', type=int, default=1,
+                        help='Number of data variables in each file [default: 1]')
+    parser.add_argument('--attributes', type=int, default=2,
+                        help='Number of attributes for each variable and globally [default: 2]')
+    parser.add_argument('--attribute-length', type=int, default=10,
+                        help='Length of the numeric attribute arrays [default: 10]')
+    parser.add_argument('--nan-fraction', type=float, default=0,
+                        help='Fraction of NaN values in the numeric attribute arrays [default: 0]')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs for each stage [default: 3]')
+    parser.add_argument('--protocol-location', dest='protocol_locations', type=parse_locations,
+                        default=(BASE_PATH / 'testing' / 'protocol').as_posix(),
+                        help='Path to the protocol [default: testing/protocol]')
+    parser.add_argument('--corpus-dir', type=Path,
+                        help='Directory for the synthetic corpus, it is kept after the run [default: temporary]')
+    parser.add_argument('--database',
+                        help='Database connection string, if set, the insert paths are benchmarked as well')
+    parser.add_argument('--output', type=Path,
+                        help='Path to the JSON file for the results [default: stdout]')
+    parser.add_argument('--compare', type=Path,
+                        help='Path to a JSON file with previous results to compare with')
+    args = parser.parse_args()
+
+    pattern = fetch_pattern(BENCHMARK_PATH, args.protocol_locations)
+    schema = fetch_schema(BENCHMARK_PATH, args.protocol_locations)
+    tree = fetch_tree(BENCHMARK_PATH, args.protocol_locations)
+
+    corpus_path = args.corpus_dir or Path(tempfile.mkdtemp(prefix='isimip-publisher-benchmark-'))
+    try:
+        generate_corpus(corpus_path, BENCHMARK_PATH, pattern, schema,
+                        datasets=args.datasets, files=args.files, size=args.size, variables=args.variables,
+                        attributes=args.attributes, attribute_length=args.attribute_length,
+                        nan_fraction=args.nan_fraction)
+
+        results = {
+            'meta': {
+                'version': VERSION,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'created': datetime.now().isoformat(),
+                'parameters': {
+                    'datasets': args.datasets,
+                    'files': args.files,
+                    'size': args.size,
+                    'variables': args.variables,
+                    'attributes': args.attributes,
+                    'attribute_length': args.attribute_length,
+                    'nan_fraction': args.nan_fraction,
+                    'repeat': args.repeat
+                }
+            },
+            'results': run_benchmarks(corpus_path, pattern, schema, tree,
+                                      repeat=args.repeat, database_settings=args.database)
+        }
+    finally:
+        if args.corpus_dir is None:
+            shutil.rmtree(corpus_path, ignore_errors=True)
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        compare_results(results, json.loads(args.compare.read_text()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,11 @@
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
 
-from tqdm import tqdm
-
 from .config import settings, store
-from .utils import database, dois, files, json, patterns, validation
+from .utils import files, json
 
 logger = logging.getLogger(__name__)
 
@@ -60,6 +61,8 @@ def diff_remote_links():
 
 
 def match_remote():
+    from .utils import patterns, validation
+
     remote_files = files.list_files(settings.REMOTE_PATH, settings.PATH,
                                     remote_dest=settings.REMOTE_DEST, suffix=settings.PATTERN['suffix'])
     datasets = patterns.match_datasets(settings.PATTERN, settings.REMOTE_PATH, remote_files,
@@ -71,6 +74,8 @@ def match_remote():
 
 
 def match_remote_links():
+    from .utils import patterns, validation
+
     remote_links = files.list_links(settings.REMOTE_PATH, settings.PATH,
                                     remote_dest=settings.REMOTE_DEST, suffix=settings.PATTERN['suffix'])
     datasets = patterns.match_datasets(settings.PATTERN, settings.REMOTE_PATH, remote_links,
@@ -82,6 +87,8 @@ def match_remote_links():
 
 
 def match_local():
+    from .utils import patterns, validation
+
     local_files = files.list_files(settings.LOCAL_PATH, settings.PATH)
     datasets = patterns.match_datasets(settings.PATTERN, settings.LOCAL_PATH, local_files,
                                        include=settings.INCLUDE, exclude=settings.EXCLUDE)
@@ -92,6 +99,8 @@ def match_local():
 
 
 def match_public():
+    from .utils import patterns, validation
+
     public_files = files.list_files(settings.PUBLIC_PATH, settings.PATH)
     datasets = patterns.match_datasets(settings.PATTERN, settings.PUBLIC_PATH, public_files,
                                        include=settings.INCLUDE, exclude=settings.EXCLUDE)
@@ -102,6 +111,8 @@ def match_public():
 
 
 def match_public_links():
+    from .utils import patterns, validation
+
     public_links = files.list_links(settings.PUBLIC_PATH, settings.PATH)
     datasets = patterns.match_datasets(settings.PATTERN, settings.PUBLIC_PATH, public_links,
                                        include=settings.INCLUDE, exclude=settings.EXCLUDE)
@@ -112,6 +123,8 @@ def match_public_links():
 
 
 def count_remote():
+    from .utils import patterns, validation
+
     remote_files = files.list_files(settings.REMOTE_PATH, settings.PATH,
                                     remote_dest=settings.REMOTE_DEST, suffix=settings.PATTERN['suffix'])
     datasets = patterns.match_datasets(settings.PATTERN, settings.REMOTE_PATH, remote_files,
@@ -121,6 +134,8 @@ def count_remote():
 
 
 def count_remote_links():
+    from .utils import patterns, validation
+
     remote_links = files.list_links(settings.REMOTE_PATH, settings.PATH,
                                     remote_dest=settings.REMOTE_DEST, suffix=settings.PATTERN['suffix'])
     datasets = patterns.match_datasets(settings.PATTERN, settings.REMOTE_PATH, remote_links,
@@ -130,6 +145,8 @@ def count_remote_links():
 
 
 def count_local():
+    from .utils import patterns, validation
+
     local_files = files.list_files(settings.LOCAL_PATH, settings.PATH)
     datasets = patterns.match_datasets(settings.PATTERN, settings.LOCAL_PATH, local_files,
                                        include=settings.INCLUDE, exclude=settings.EXCLUDE)
@@ -138,6 +155,8 @@ def count_local():
 
 
 def count_public():
+    from .utils import patterns, validation
+
     public_files = files.list_files(settings.PUBLIC_PATH, settings.PATH)
     datasets = patterns.match_datasets(settings.PATTERN, settings.PUBLIC_PATH, public_files,
                                        include=settings.INCLUDE, exclude=settings.EXCLUDE)
@@ -146,6 +165,8 @@ def count_public():
 
 
 def count_public_links():
+    from .utils import patterns, validation
+
     public_links = files.list_links(settings.PUBLIC_PATH, settings.PATH)
     datasets = patterns.match_datasets(settings.PATTERN, settings.PUBLIC_PATH, public_links,
                                        include=settings.INCLUDE, exclude=settings.EXCLUDE)
@@ -154,6 +175,10 @@ def count_public_links():
 
 
 def fetch_files():
+    from tqdm import tqdm
+
+    from .utils import patterns, validation
+
     if settings.RESOLVE_LINKS:
         remote_files = files.list_all(settings.REMOTE_PATH, settings.PATH,
                                       remote_dest=settings.REMOTE_DEST, suffix=settings.PATTERN['suffix'])
@@ -173,6 +198,8 @@ def fetch_files():
 
 
 def write_local_jsons():
+    from .utils import patterns, validation
+
     if not store.datasets:
         local_files = files.list_files(settings.LOCAL_PATH, settings.PATH)
         datasets = patterns.match_datasets(settings.PATTERN, settings.LOCAL_PATH, local_files,
@@ -180,35 +207,47 @@ def write_local_jsons():
         validation.validate_datasets(settings.SCHEMA, settings.PATH, datasets)
         store.datasets = datasets
 
-    for dataset in tqdm(store.datasets, desc='write_local_jsons'.ljust(18)):
-        for file in dataset.files:
-            json.write_json_file(file.abspath, file.json)
+    write_jsons(store.datasets, 'write_local_jsons')
 
 
 def write_public_jsons():
+    from .utils import patterns, validation
+
     public_files = files.list_files(settings.PUBLIC_PATH, settings.PATH)
     datasets = patterns.match_datasets(settings.PATTERN, settings.PUBLIC_PATH, public_files,
                                        include=settings.INCLUDE, exclude=settings.EXCLUDE)
     validation.validate_datasets(settings.SCHEMA, settings.PATH, datasets)
 
-    for dataset in tqdm(datasets, desc='write_public_jsons'.ljust(18)):
-        for file in dataset.files:
-            json.write_json_file(file.abspath, file.json)
+    write_jsons(datasets, 'write_public_jsons')
 
 
 def write_link_jsons():
+    from .utils import patterns, validation
+
     public_links = files.list_links(settings.PUBLIC_PATH, settings.PATH)
     filtered_links = files.filter_links(settings.PUBLIC_PATH, settings.TARGET_PATH, settings.PATH, public_links)
     datasets = patterns.match_datasets(settings.PATTERN, settings.PUBLIC_PATH, filtered_links,
                                        include=settings.INCLUDE, exclude=settings.EXCLUDE)
     validation.validate_datasets(settings.SCHEMA, settings.PATH, datasets)
 
-    for dataset in tqdm(datasets, desc='write_link_jsons'.ljust(18)):
-        for file in dataset.files:
-            json.write_json_file(file.abspath, file.json)
+    write_jsons(datasets, 'write_link_jsons')
+
+
+def write_jsons(datasets, desc):
+    from tqdm import tqdm
+
+    dataset_files = [file for dataset in datasets for file in dataset.files]
+
+    t = tqdm(total=len(dataset_files), desc=desc.ljust(18))
+    for n in json.write_json_files(dataset_files, workers=settings.WORKERS):
+        t.update(n)
 
 
 def insert_datasets():
+    from tqdm import tqdm
+
+    from .utils import database, patterns, validation
+
     if not store.datasets:
         local_files = files.list_files(settings.LOCAL_PATH, settings.PATH)
         datasets = patterns.match_datasets(settings.PATTERN, settings.LOCAL_PATH, local_files,
@@ -218,19 +257,33 @@ def insert_datasets():
 
     session = database.init_database_session(settings.DATABASE)
 
-    for dataset in store.datasets:
-        for file in dataset.files:
-            database.check_file_id(session, file.path, file.uuid)
-
-    for dataset in tqdm(store.datasets, desc='insert_datasets'.ljust(18)):
-        database.insert_dataset(session, settings.VERSION, settings.RIGHTS, settings.RESTRICTED,
-                                dataset.name, dataset.path, dataset.size, dataset.specifiers)
-
-        for file in dataset.files:
-            database.insert_file(session, settings.VERSION, file.dataset.path, file.uuid, file.name, file.path,
-                                file.size, file.checksum, file.checksum_type, file.cleaned_header, file.specifiers)
-
-        session.commit()
+    # the headers of all files are read (in parallel) and their ids are checked before the first dataset
+    # is written, so that nothing is written if one of the ids already exists in the database
+    dataset_files = [file for dataset in store.datasets for file in dataset.files]
+    files.read_netcdf_headers(dataset_files, workers=settings.WORKERS)
+    database.check_file_ids(session, dataset_files)
+
+    # the checksums are computed in batches in the main thread, while the datasets of the previous batches
+    # are written to the database by a separate thread (using a separate session) at the same time
+    write_session = database.init_database_session(settings.DATABASE)
+    failed = threading.Event()
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor, \
+                tqdm(total=len(store.datasets), desc='insert_datasets'.ljust(18)) as progress:
+            futures = []
+            for batch in prepare_datasets(store.datasets):
+                if failed.is_set():
+                    break
+
+                for dataset in batch:
+                    future = executor.submit(write_dataset, write_session, dataset, failed)
+                    future.add_done_callback(lambda future: progress.update(1))
+                    futures.append(future)
+
+            for future in futures:
+                future.result()
+    finally:
+        write_session.close()
 
     database.update_search(session, settings.PATH)
     database.update_views(session)
@@ -239,7 +292,53 @@ def insert_datasets():
     session.close()
 
 
+def prepare_datasets(datasets, batch_size=1000):
+    # compute the checksums for batches of about batch_size files, one batch at a time
+    batches = [[]]
+    for dataset in datasets:
+        if sum(len(batch_dataset.files) for batch_dataset in batches[-1]) >= batch_size:
+            batches.append([])
+        batches[-1].append(dataset)
+
+    for batch in batches:
+        batch_files = [file for dataset in batch for file in dataset.files]
+        files.compute_checksums(batch_files, workers=settings.WORKERS)
+
+        # clean the headers here, so that the other thread only needs to write to the database
+        for file in batch_files:
+            file.cleaned_header  # noqa: B018
+
+        yield batch
+
+
+def write_dataset(session, dataset, failed):
+    from .utils import database
+
+    # skip the remaining datasets if one dataset could not be written
+    if failed.is_set():
+        return
+
+    try:
+        db_dataset = database.insert_dataset(session, settings.VERSION, settings.RIGHTS, settings.RESTRICTED,
+                                             dataset.name, dataset.path, dataset.size, dataset.specifiers)
+
+        # the files only need to be inserted (or checked) if the digest of the stored dataset is different
+        if db_dataset.digest != dataset.digest:
+            database.insert_files(session, settings.VERSION, db_dataset, dataset.files)
+            database.update_dataset_digest(session, db_dataset)
+
+        session.commit()
+    except Exception:
+        failed.set()
+        session.rollback()
+        raise
+
+
 def link_links():
+    from tqdm import tqdm
+
+    from .utils import patterns, validation
+
     remote_links = files.list_links(settings.REMOTE_PATH, settings.PATH,
                                     remote_dest=settings.REMOTE_DEST, suffix=settings.PATTERN['suffix'])
     filtered_links = files.filter_links(settings.PUBLIC_PATH, settings.TARGET_PATH, settings.PATH, remote_links)
@@ -247,12 +346,18 @@ def link_links():
                                        include=settings.INCLUDE, exclude=settings.EXCLUDE)
     validation.validate_datasets(settings.SCHEMA, settings.PATH, datasets)
 
-    for dataset in tqdm(datasets, desc='link_links'.ljust(18)):
-        for file in dataset.files:
-            files.link_file(settings.PUBLIC_PATH, settings.TARGET_PATH, settings.PATH, file.path)
+    link_paths = [file.path for dataset in datasets for file in dataset.files]
+    with tqdm(total=len(link_paths), desc='link_links'.ljust(18)) as progress:
+        for count in files.link_files(settings.PUBLIC_PATH, settings.TARGET_PATH, settings.PATH, link_paths,
+                                      workers=settings.WORKERS):
+            progress.update(count)
 
 
 def link_files():
+    from tqdm import tqdm
+
+    from .utils import patterns, validation
+
     remote_files = files.list_files(settings.REMOTE_PATH, settings.PATH,
                                     remote_dest=settings.REMOTE_DEST, suffix=settings.PATTERN['suffix'])
     filtered_links = files.filter_links(settings.PUBLIC_PATH, settings.TARGET_PATH, settings.PATH, remote_files)
@@ -260,12 +365,18 @@ def link_files():
                                        include=settings.INCLUDE, exclude=settings.EXCLUDE)
     validation.validate_datasets(settings.SCHEMA, settings.PATH, datasets)
 
-    for dataset in tqdm(datasets, desc='link_files'.ljust(18)):
-        for file in dataset.files:
-            files.link_file(settings.PUBLIC_PATH, settings.TARGET_PATH, settings.PATH, file.path)
+    link_paths = [file.path for dataset in datasets for file in dataset.files]
+    with tqdm(total=len(link_paths), desc='link_files'.ljust(18)) as progress:
+        for count in files.link_files(settings.PUBLIC_PATH, settings.TARGET_PATH, settings.PATH, link_paths,
+                                      workers=settings.WORKERS):
+            progress.update(count)
 
 
 def link_datasets():
+    from tqdm import tqdm
+
+    from .utils import database, patterns, validation
+
     # collect and validate the links
     public_links = files.list_links(settings.PUBLIC_PATH, settings.PATH)
     filtered_links = files.filter_links(settings.PUBLIC_PATH, settings.TARGET_PATH, settings.PATH, public_links)
@@ -275,16 +386,17 @@ def link_datasets():
 
     session = database.init_database_session(settings.DATABASE)
 
-    for dataset in tqdm(datasets, desc='link_datasets'.ljust(18)):
-        target_dataset_path = str(settings.TARGET_PATH / Path(dataset.path).relative_to(settings.PATH))
-        database.insert_dataset_link(session, settings.RIGHTS, settings.RESTRICTED,
-                                     target_dataset_path, dataset.name, dataset.path, dataset.size, dataset.specifiers)
+    # the links point to files in the database, so their headers can be reused
+    dataset_files = [file for dataset in datasets for file in dataset.files]
+    files.compute_checksums(dataset_files, workers=settings.WORKERS)
+    headers = database.retrieve_netcdf_headers(session, dataset_files)
+    files.read_netcdf_headers(dataset_files, headers=headers, workers=settings.WORKERS)
 
-        for file in dataset.files:
-            target_file_path = str(settings.TARGET_PATH / Path(file.path).relative_to(settings.PATH))
-            database.insert_file_link(session, target_file_path, file.dataset.path,
-                                      file.name, file.path, file.size, file.checksum, file.checksum_type,
-                                      file.cleaned_header, file.specifiers)
+    # the datasets and files are linked in bulk, using a few queries for all datasets
+    with tqdm(total=len(datasets), desc='link_datasets'.ljust(18)) as progress:
+        database.insert_links(session, settings.RIGHTS, settings.RESTRICTED, settings.TARGET_PATH, settings.PATH,
+                              datasets)
+        progress.update(len(datasets))
 
     session.commit()
     database.update_tree(session, settings.PATH, settings.TREE)
@@ -300,6 +412,10 @@ def link_datasets():
 
 
 def publish_datasets():
+    from tqdm import tqdm
+
+    from .utils import database, patterns, validation
+
     if not store.datasets:
         local_files = files.list_files(settings.LOCAL_PATH, settings.PATH)
         datasets = patterns.match_datasets(settings.PATTERN, settings.LOCAL_PATH, local_files,
@@ -309,16 +425,21 @@ def publish_datasets():
 
     session = database.init_database_session(settings.DATABASE)
 
+    public_path = Path(settings.PUBLIC_PATH) if not settings.RESTRICTED else Path(settings.RESTRICTED_PATH)
+
     for dataset in tqdm(store.datasets, desc='publish_datasets'.ljust(18)):
         database.publish_dataset(session, settings.VERSION, dataset.path)
 
+        file_paths = []
         for file in dataset.files:
             source_path = Path(file.abspath)
-            public_path = Path(settings.PUBLIC_PATH) if not settings.RESTRICTED else Path(settings.RESTRICTED_PATH)
-            target_path = Path(public_path) / Path(source_path).relative_to(settings.LOCAL_PATH)
+            target_path = public_path / source_path.relative_to(settings.LOCAL_PATH)
 
-            files.move_file(source_path, target_path)
-            files.move_file(source_path.with_suffix('.json'), target_path.with_suffix('.json'))
+            file_paths.append((source_path, target_path))
+            file_paths.append((source_path.with_suffix('.json'), target_path.with_suffix('.json')))
+
+        for _ in files.move_files(file_paths, workers=settings.WORKERS):
+            pass
 
         session.commit()
 
@@ -330,6 +451,10 @@ def publish_datasets():
 
 
 def update_datasets():
+    from tqdm import tqdm
+
+    from .utils import database, patterns, validation
+
     public_files = files.list_files(settings.PUBLIC_PATH, settings.PATH)
     datasets = patterns.match_datasets(settings.PATTERN, settings.PUBLIC_PATH, public_files,
                                        include=settings.INCLUDE, exclude=settings.EXCLUDE)
@@ -337,13 +462,12 @@ def update_datasets():
 
     session = database.init_database_session(settings.DATABASE)
 
-    for dataset in tqdm(datasets, desc='update_datasets'.ljust(18)):
-        database.update_dataset(session, settings.RIGHTS, settings.RESTRICTED, dataset.path, dataset.specifiers)
+    # the datasets and files are updated in bulk, only rows which actually changed are written
+    with tqdm(total=len(datasets), desc='update_datasets'.ljust(18)) as progress:
+        database.update_datasets(session, settings.RIGHTS, settings.RESTRICTED, datasets)
+        progress.update(len(datasets))
 
-        for file in dataset.files:
-            database.update_file(session, file.dataset.path, file.path, file.specifiers)
-
-        session.commit()
+    session.commit()
 
     database.update_search(session, settings.PATH)
     session.commit()
@@ -356,14 +480,18 @@ def update_datasets():
     session.close()
 
 
-def archive_datasets():
+def archive_datasets(batch_size=100):
+    from tqdm import tqdm
+
+    from .utils import database, patterns
+
     session = database.init_database_session(settings.DATABASE)
 
     # since we have only files, not datasets (patterns could have changed since publication),
     # we retrieve all datasets for this path and remove datasets which have no files in public_files
     path = Path(settings.PATH)
     like = not bool(path.suffix)
-    db_datasets = database.retrieve_datasets(session, path, public=True, like=like)
+    db_datasets = database.retrieve_datasets(session, path, public=True, like=like, links=True)
 
     # apply include and exclude lists on the datasets from the database
     datasets = patterns.filter_datasets(db_datasets, include=settings.INCLUDE, exclude=settings.EXCLUDE)
@@ -372,46 +500,70 @@ def archive_datasets():
     string = input()
 
     if string.lower() == 'yes':
-        for dataset in tqdm(datasets, desc='archive_datasets'.ljust(18)):
-            for link in dataset.links:
-                link_version = database.archive_dataset(session, link.path)
-                if link_version:
-                    archive_path = settings.ARCHIVE_PATH / link_version
-                    for file in link.files:
-                        source_path = settings.PUBLIC_PATH / file.path
-                        target_path = archive_path / Path(source_path).relative_to(settings.PUBLIC_PATH)
+        # the datasets are archived in batches, the database is committed after the files of a batch were moved,
+        # so that a failure leaves only the current batch, which is rolled back and whose files are moved back
+        # the paths are collected upfront, since the datasets are expired after each commit,
+        # a dict is used to remove duplicate datasets (e.g. links which were also retrieved directly)
+        dataset_files = {}
+        for archive_dataset in [link for dataset in datasets for link in dataset.links] + datasets:
+            dataset_files[archive_dataset.path] = [file.path for file in archive_dataset.files]
+        dataset_paths = list(dataset_files)
+
+        with tqdm(total=len(dataset_paths), desc='archive_datasets'.ljust(18)) as progress:
+            for i in range(0, len(dataset_paths), batch_size):
+                batch = {path: dataset_files[path] for path in dataset_paths[i:i + batch_size]}
+                archive_batch(session, batch)
+                progress.update(len(batch))
+
+        database.update_tree(session, settings.PATH, settings.TREE)
+        session.commit()
+
+        database.clean_tree(session)
+        session.commit()
 
-                        if source_path.is_symlink():
-                            files.move_file(source_path, target_path)
+    session.close()
 
-                        if source_path.with_suffix('.json').is_file():
-                            files.move_file(source_path.with_suffix('.json'), target_path.with_suffix('.json'))
 
-            dataset_version = database.archive_dataset(session, dataset.path)
-            if dataset_version:
-                archive_path = settings.ARCHIVE_PATH / dataset_version
-                for file in dataset.files:
-                    source_path = settings.PUBLIC_PATH / file.path
-                    target_path = archive_path / Path(source_path).relative_to(settings.PUBLIC_PATH)
+def archive_batch(session, dataset_files):
+    from .utils import database
 
-                    if source_path.is_file():
-                        files.move_file(source_path, target_path)
+    # mark the public versions of the datasets archived using a single statement
+    versions = database.archive_datasets(session, list(dataset_files))
 
-                    if source_path.with_suffix('.json').is_file():
-                        files.move_file(source_path.with_suffix('.json'), target_path.with_suffix('.json'))
+    # use a dict to remove duplicate moves, but keep the order
+    file_paths = {}
+    for dataset_path, dataset_file_paths in dataset_files.items():
+        if dataset_path in versions:
+            archive_path = settings.ARCHIVE_PATH / versions[dataset_path]
+            for file_path in dataset_file_paths:
+                source_path = settings.PUBLIC_PATH / file_path
+                target_path = archive_path / file_path
 
-            session.commit()
+                file_paths[source_path] = target_path
+                file_paths[source_path.with_suffix('.json')] = target_path.with_suffix('.json')
 
-        database.update_tree(session, settings.PATH, settings.TREE)
-        session.commit()
+    # files which do not exist (anymore) are skipped
+    try:
+        for _ in files.move_files(file_paths.items(), workers=settings.WORKERS, missing_ok=True):
+            pass
+    except Exception:
+        session.rollback()
 
-        database.clean_tree(session)
-        session.commit()
+        logger.error('archive failed, move %d files back', len(file_paths))
+        for _ in files.move_files([(target_path, source_path) for source_path, target_path in file_paths.items()],
+                                  workers=settings.WORKERS, missing_ok=True):
+            pass
+        raise
 
-    session.close()
+    session.commit()
 
 
 def check():
+    from .utils import database, patterns, validation
+
+    # the start of the check is logged, so that it can be used for --since in the next check
+    logger.info('check %s started at %s', settings.PATH, datetime.now().astimezone().isoformat())
+
     public_files = files.list_files(settings.PUBLIC_PATH, settings.PATH)
     datasets = patterns.match_datasets(settings.PATTERN, settings.PUBLIC_PATH, public_files,
                                        include=settings.INCLUDE, exclude=settings.EXCLUDE)
@@ -427,16 +579,22 @@ def check():
 
     session = database.init_database_session(settings.DATABASE)
 
-    # retrieve all datasets for this path and remove datasets which have no files in public_files
+    # retrieve all datasets for this path and remove datasets which are not included or excluded,
+    # so that they are not reported as missing on the file system
     path = Path(settings.PATH)
     db_datasets = database.retrieve_datasets(session, (path.parent if path.suffix else path), public=True)
+    db_datasets = patterns.filter_datasets(db_datasets, include=(settings.INCLUDE or [settings.PATH]),
+                                           exclude=settings.EXCLUDE)
 
-    validation.check_datasets(datasets, db_datasets, settings.SKIP_CHECKSUM)
+    validation.check_datasets(datasets, db_datasets, skip_checksum=settings.SKIP_CHECKSUM,
+                              sample=settings.SAMPLE, since=settings.SINCE, workers=settings.WORKERS)
 
     session.close()
 
 
 def update_tree():
+    from .utils import database
+
     session = database.init_database_session(settings.DATABASE)
 
     database.update_tree(session, settings.PATH, settings.TREE)
@@ -447,6 +605,8 @@ def update_tree():
     session.close()
 
 def update_search():
+    from .utils import database
+
     session = database.init_database_session(settings.DATABASE)
 
     database.update_search(session, settings.PATH)
@@ -454,7 +614,37 @@ def update_search():
     session.close()
 
 
+def update_header_hashes():
+    from .utils import database
+
+    session = database.init_database_session(settings.DATABASE)
+
+    database.update_header_hashes(session)
+    session.commit()
+    session.close()
+
+
+def create_columns():
+    from .utils import database
+
+    session = database.init_database_session(settings.DATABASE, check_columns=False)
+
+    database.create_columns(session.get_bind())
+    session.close()
+
+
+def create_indexes():
+    from .utils import database
+
+    session = database.init_database_session(settings.DATABASE)
+
+    database.create_concurrent_indexes(session.get_bind())
+    session.close()
+
+
 def update_views():
+    from .utils import database
+
     session = database.init_database_session(settings.DATABASE)
 
     database.update_views(session)
@@ -469,14 +659,12 @@ def clean():
 
 
 def insert_doi():
+    from .utils import database, dois
+
     session = database.init_database_session(settings.DATABASE)
 
     resource = database.insert_resource(session, settings.RESOURCE, settings.PATHS, settings.DATACITE_PREFIX)
-
-    session.commit()
-
-    for path in resource.paths:
-        database.update_search(session, path)
+    database.update_resource_search(session, resource)
 
     session.commit()
 
@@ -490,12 +678,12 @@ def insert_doi():
 
 
 def update_doi():
+    from .utils import database, dois
+
     session = database.init_database_session(settings.DATABASE)
 
     resource = database.update_resource(session, settings.RESOURCE)
-
-    for path in resource.paths:
-        database.update_search(session, path)
+    database.update_resource_search(session, resource)
 
     session.commit()
 
@@ -508,6 +696,8 @@ def update_doi():
 
 
 def register_doi():
+    from .utils import database, dois
+
     if dois.confirm_upload():
         session = database.init_database_session(settings.DATABASE)
         resource = database.fetch_resource(session, settings.DOI)
@@ -517,19 +707,11 @@ def register_doi():
 
 
 def check_doi():
-    session = database.init_database_session(settings.DATABASE)
-    datasets = database.retrieve_datasets(session, settings.PATH,
-                                          public=(not settings.ARCHIVED), like=True, follow=False)
-    if not datasets:
-        raise RuntimeError(f'no dataset found for {settings.PATH}')
+    from .utils import database
 
-    for dataset in datasets:
-        resources = dataset.target.resources if dataset.target is not None else dataset.resources
+    session = database.init_database_session(settings.DATABASE)
 
-        if not resources or not any(
-            dataset.path.startswith(resource_path) for resource in resources for resource_path in resource.paths
-        ):
-            for file in dataset.files:
-                print(file.path)
+    for file_path in database.retrieve_uncovered_file_paths(session, settings.PATH, public=(not settings.ARCHIVED)):
+        print(file_path)
 
     session.close()
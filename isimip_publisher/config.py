@@ -9,6 +9,8 @@ from isimip_utils.exceptions import ConfigError
 from isimip_utils.fetch import fetch_json, load_json
 from isimip_utils.protocol import fetch_definitions, fetch_pattern, fetch_schema, fetch_tree
 
+from .utils.protocol import get_protocol_locations
+
 logger = logging.getLogger(__name__)
 
 RIGHTS_CHOICES = [
@@ -79,29 +81,38 @@ class Settings(BaseSettings):
 
         return resource
 
+    def get_protocol_locations(self, sub_location):
+        cache_dir = getattr(self, 'PROTOCOL_CACHE_DIR', None)
+        offline = getattr(self, 'OFFLINE', False)
+        if offline and cache_dir is None:
+            raise ConfigError('PROTOCOL_CACHE_DIR needs to be set for offline mode')
+
+        return get_protocol_locations(self.PATH, self.PROTOCOL_LOCATIONS, sub_location, cache_dir=cache_dir,
+                                      ttl=getattr(self, 'PROTOCOL_CACHE_TTL', 3600), offline=offline)
+
     @cached_property
     def DEFINITIONS(self):
         if self.PROTOCOL_LOCATIONS is None:
             raise ConfigError('PROTOCOL_LOCATIONS is not set')
-        return fetch_definitions(self.PATH, self.PROTOCOL_LOCATIONS)
+        return fetch_definitions(self.PATH, self.get_protocol_locations('definitions'))
 
     @cached_property
     def PATTERN(self):
         if self.PROTOCOL_LOCATIONS is None:
             raise ConfigError('PROTOCOL_LOCATIONS is not set')
-        return fetch_pattern(self.PATH, self.PROTOCOL_LOCATIONS)
+        return fetch_pattern(self.PATH, self.get_protocol_locations('pattern'))
 
     @cached_property
     def SCHEMA(self):
         if self.PROTOCOL_LOCATIONS is None:
             raise ConfigError('PROTOCOL_LOCATIONS is not set')
-        return fetch_schema(self.PATH, self.PROTOCOL_LOCATIONS)
+        return fetch_schema(self.PATH, self.get_protocol_locations('schema'))
 
     @cached_property
     def TREE(self):
         if self.PROTOCOL_LOCATIONS is None:
             raise ConfigError('PROTOCOL_LOCATIONS is not set')
-        return fetch_tree(self.PATH, self.PROTOCOL_LOCATIONS)
+        return fetch_tree(self.PATH, self.get_protocol_locations('tree'))
 
 
 class Store(Singleton):
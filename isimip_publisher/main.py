@@ -1,4 +1,5 @@
-from datetime import date
+import argparse
+from datetime import date, datetime
 
 from isimip_utils.cli import ArgumentParser, parse_filelist, parse_locations, parse_version, setup_logs
 
@@ -13,6 +14,8 @@ from .commands import (
     count_public_links,
     count_remote,
     count_remote_links,
+    create_columns,
+    create_indexes,
     diff_remote,
     diff_remote_links,
     fetch_files,
@@ -35,6 +38,7 @@ from .commands import (
     register_doi,
     update_datasets,
     update_doi,
+    update_header_hashes,
     update_search,
     update_tree,
     update_views,
@@ -43,6 +47,20 @@ from .commands import (
     write_public_jsons,
 )
 from .config import RIGHTS_CHOICES, settings
+from .utils.profiling import profiler
+
+
+def parse_sample(value):
+    # the sample is a fraction of the files, so it needs to be in (0, 1]
+    try:
+        sample = float(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f'invalid float value: {value!r}') from e
+
+    if not 0 < sample <= 1:
+        raise argparse.ArgumentTypeError(f'{value} is not in (0, 1]')
+
+    return sample
 
 
 def main():
@@ -76,6 +94,12 @@ def main():
     parser.add_argument('--protocol-location', dest='protocol_locations', type=parse_locations,
                         default='https://protocol.isimip.org https://protocol2.isimip.org',
                         help='URL or file path to the protocol')
+    parser.add_argument('--protocol-cache-dir', dest='protocol_cache_dir',
+                        help='Directory to cache the protocol files fetched from URLs [default: no caching]')
+    parser.add_argument('--protocol-cache-ttl', dest='protocol_cache_ttl', type=int, default=3600,
+                        help='Time in seconds before cached protocol files are revalidated [default: 3600]')
+    parser.add_argument('--offline', dest='offline', action='store_true', default=False,
+                        help='Use only the cached protocol files, needs --protocol-cache-dir')
     parser.add_argument('--datacite-username', dest='datacite_username',
                         help='Username for DataCite')
     parser.add_argument('--datacite-password', dest='datacite_password',
@@ -96,8 +120,23 @@ def main():
                          help='Skip the registration of the DOI when inserting/updating a resource')
     parser.add_argument('--skip-checksum', dest='skip_checksum', action='store_true', default=False,
                          help='Skip the computation of the checksum when checking')
+    parser.add_argument('--sample', dest='sample', type=parse_sample,
+                        help='Fraction of the files to check, e.g. 0.01 [default: all files]')
+    parser.add_argument('--since', dest='since', type=datetime.fromisoformat,
+                        help='Only check files which were modified after this date, e.g. the last check')
     parser.add_argument('--resolve-links', dest='resolve_links', action='store_true', default=False,
                          help='Resolve remote links as if they were files')
+    parser.add_argument('--workers', dest='workers', type=int,
+                        help='Number of parallel workers for file operations [default: depends on the number of CPUs]')
+    parser.add_argument('--profile', dest='profile', action='store_true', default=False,
+                        help='Measure the time spent in each command and stage and write a report')
+    parser.add_argument('--profile-file', dest='profile_file', default='profile.json',
+                        help='Path to the JSON file for the profile report [default: profile.json]')
+    parser.add_argument('--profile-stage', dest='profile_stage',
+                        help='Command or stage (e.g. checksum, header, database) to run with cProfile,'
+                             ' the stats are written next to the profile file')
+    parser.add_argument('--max-queries-per-file', dest='max_queries_per_file', type=float,
+                        help='Log a warning if a command issues more database queries per file')
     parser.add_argument('--log-level', dest='log_level', default='WARN',
                         help='Log level (ERROR, WARN, INFO, or DEBUG)')
     parser.add_argument('--log-file', dest='log_file',
@@ -144,7 +183,7 @@ def main():
         subparser.add_argument('target_path', help='path of the files to process')
         subparser.add_argument('path', help='path for the links')
 
-    for command in [init, update_views]:
+    for command in [init, create_columns, create_indexes, update_header_hashes, update_views]:
         subparser = subparsers.add_parser(command.__name__)
         subparser.set_defaults(command=command)
 
@@ -155,23 +194,33 @@ def main():
     settings.from_dict(vars(args))
 
     if hasattr(args, 'command'):
-        args.command()
+        if settings.PROFILE:
+            profiler.enable(settings.PROFILE_STAGE)
+
+        with profiler.command(args.command.__name__, settings.MAX_QUERIES_PER_FILE):
+            args.command()
+
+        if settings.PROFILE:
+            profiler.report(settings.PROFILE_FILE)
+            profiler.disable()
     else:
         parser.print_help()
 
 
 def init():
+    create_columns()
+    create_indexes()
+    update_header_hashes()
     update_views()
 
 
 def run():
-    fetch_files()
-    write_local_jsons()
-    insert_datasets()
-    publish_datasets()
+    for command in [fetch_files, write_local_jsons, insert_datasets, publish_datasets]:
+        with profiler.command(command.__name__, settings.MAX_QUERIES_PER_FILE):
+            command()
 
 
 def link():
-    link_links()
-    write_link_jsons()
-    link_datasets()
+    for command in [link_links, write_link_jsons, link_datasets]:
+        with profiler.command(command.__name__, settings.MAX_QUERIES_PER_FILE):
+            command()
@@ -1,18 +1,29 @@
 import logging
-from functools import cached_property
+from itertools import count
 from pathlib import Path
 
 import jsonschema
 from isimip_utils.checksum import get_checksum, get_checksum_type
-from isimip_utils.netcdf import get_dimensions, get_global_attributes, get_variables, open_dataset_read
 
-from .utils.files import clean_header
+from .utils.files import clean_header, get_digest, read_netcdf_header
+from .utils.headers import header_store
+from .utils.profiling import timed
+from .utils.validation import validate_specifiers
 
 logger = logging.getLogger(__name__)
 
+# marks the headers which were not read yet, since None is used for files without header
+UNSET = object()
+
+# keys for the headers in the header store
+header_keys = count()
+
 
 class Dataset:
 
+    # slots instead of a __dict__, since all datasets and files are kept in memory between the stages of run
+    __slots__ = ('_digest', '_size', 'clean', 'exclude', 'files', 'name', 'path', 'specifiers')
+
     def __init__(self, name=None, path=None, specifiers=None):
         self.name = name
         self.path = path
@@ -22,68 +33,127 @@ class Dataset:
         self.clean = False
 
         self._size = None
-        self._checksum = None
+        self._digest = None
 
-    @cached_property
+    @property
     def size(self):
-        return sum([file.size for file in self.files])
+        if self._size is None:
+            self._size = sum([file.size for file in self.files])
+        return self._size
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = get_digest([(file.path, file.checksum) for file in self.files])
+        return self._digest
 
     def validate(self, schema):
         # validate if self.clean is not true yet
         if self.clean:
             return self.clean
         else:
-            instance = {
-                'specifiers': dict(self.specifiers)
-            }
+            specifiers = dict(self.specifiers)
             try:
-                jsonschema.validate(schema=schema, instance=instance)
+                validate_specifiers(schema, specifiers)
                 self.clean = True
             except jsonschema.exceptions.ValidationError as e:
-                logger.error('instance = %s', instance)
+                logger.error('instance = %s', {'specifiers': specifiers})
                 raise e
 
 
 class File:
 
-    def __init__(self, dataset=None, name=None, path=None, abspath=None, specifiers=None):
+    # only the paths, the size, the checksum, and the uuid are kept in memory, the headers
+    # are spilled to the header store and only their key is kept, the name is derived from the path
+    __slots__ = (
+        '_checksum',
+        '_cleaned_header',
+        '_netcdf_header',
+        '_size',
+        '_uuid',
+        'abspath',
+        'checksum_type',
+        'clean',
+        'dataset',
+        'path',
+        'specifiers',
+    )
+
+    def __init__(self, dataset=None, path=None, abspath=None, specifiers=None):
         self.dataset = dataset
-        self.name = name
         self.path = path
         self.abspath = abspath
         self.specifiers = specifiers
         self.checksum_type = get_checksum_type()
         self.clean = False
 
-    @cached_property
+        self._size = None
+        self._checksum = None
+        self._uuid = None
+        self._netcdf_header = UNSET
+        self._cleaned_header = UNSET
+
+    @property
+    def name(self):
+        return Path(self.path).name
+
+    @property
     def uuid(self):
-        if self.netcdf_header:
-            return self.netcdf_header.get('global_attributes', {}).get('isimip_id')
+        if self._netcdf_header is UNSET:
+            self.netcdf_header = self.read_netcdf_header()
+        return self._uuid
+
+    @property
+    def netcdf_header_read(self):
+        return self._netcdf_header is not UNSET
 
-    @cached_property
+    @property
     def netcdf_header(self):
-        if Path(self.path).suffix.startswith('.nc'):
-            with open_dataset_read(self.abspath) as dataset:
-                return {
-                    'dimensions': get_dimensions(dataset),
-                    'variables': get_variables(dataset, convert=True),
-                    'global_attributes': get_global_attributes(dataset, convert=True)
-                }
-
-    @cached_property
-    def cleaned_header(self):
-        if self.netcdf_header:
-            return clean_header(self.netcdf_header)
+        if self._netcdf_header is UNSET:
+            self.netcdf_header = self.read_netcdf_header()
+
+        if self._netcdf_header is not None:
+            return header_store.get(self._netcdf_header, 'netcdf_header')
+
+    @netcdf_header.setter
+    def netcdf_header(self, netcdf_header):
+        if netcdf_header:
+            self._uuid = netcdf_header.get('global_attributes', {}).get('isimip_id')
+            self._netcdf_header = next(header_keys)
+            header_store.set(self._netcdf_header, 'netcdf_header', netcdf_header)
+        else:
+            self._uuid = None
+            self._netcdf_header = None
+        self._cleaned_header = UNSET
 
-    @cached_property
+    @property
+    def cleaned_header(self):
+        if self._cleaned_header is UNSET:
+            cleaned_header = self.clean_header()
+            if cleaned_header is None:
+                self._cleaned_header = None
+            else:
+                # the cleaned header is stored with the same key as the header
+                header_store.set(self._netcdf_header, 'cleaned_header', cleaned_header)
+                self._cleaned_header = self._netcdf_header
+            return cleaned_header
+
+        if self._cleaned_header is not None:
+            return header_store.get(self._cleaned_header, 'cleaned_header')
+
+    @property
     def size(self):
-        return Path(self.abspath).stat().st_size
+        if self._size is None:
+            self._size = Path(self.abspath).stat().st_size
+        return self._size
 
-    @cached_property
+    @property
     def checksum(self):
-        return get_checksum(self.abspath, self.checksum_type)
+        if self._checksum is None:
+            self._checksum = self.compute_checksum()
+        return self._checksum
 
-    @cached_property
+    @property
     def json(self):
         return {
             'id': self.uuid,
@@ -95,17 +165,30 @@ class File:
             'netcdf_header': self.netcdf_header
         }
 
+    @timed('header')
+    def read_netcdf_header(self):
+        if Path(self.path).suffix.startswith('.nc'):
+            return read_netcdf_header(self.abspath)
+
+    @timed('header')
+    def clean_header(self):
+        netcdf_header = self.netcdf_header
+        if netcdf_header:
+            return clean_header(netcdf_header)
+
+    @timed('checksum')
+    def compute_checksum(self):
+        return get_checksum(self.abspath, self.checksum_type)
+
     def validate(self, schema):
         # validate if self.clean is not true yet
         if self.clean:
             return self.clean
         else:
-            instance = {
-                'specifiers': dict(self.specifiers)
-            }
+            specifiers = dict(self.specifiers)
             try:
-                jsonschema.validate(schema=schema, instance=instance)
+                validate_specifiers(schema, specifiers)
                 self.clean = True
             except jsonschema.exceptions.ValidationError as e:
-                logger.error('instance = %s', instance)
+                logger.error('instance = %s', {'specifiers': specifiers})
                 raise e
@@ -1,5 +1,8 @@
+import json
 import os
 import shutil
+import subprocess
+import sys
 from datetime import datetime
 from pathlib import Path
 
@@ -7,7 +10,10 @@ import pytest
 from dotenv import load_dotenv
 from sqlalchemy import text
 
-from isimip_publisher.utils.database import init_database_session
+from isimip_publisher.utils.database import Dataset, File, init_database_session
+
+# time budget in seconds for the imports of a listing command, measured using python -X importtime
+IMPORT_TIME_BUDGET = 0.5
 
 
 @pytest.fixture(scope='session')
@@ -182,6 +188,43 @@ def test_list_local(setup, local_files, script_runner):
     assert len(response.stdout.splitlines()) == 6
 
 
+def test_list_local_profile(setup, local_files, tmp_path, script_runner):
+    profile_file = tmp_path / 'profile.json'
+    response = script_runner.run(['isimip-publisher', '--profile', '--profile-file', str(profile_file),
+                                  '--profile-stage', 'listing', 'list_local', 'round/product/sector'])
+    assert response.success, response.stderr
+    assert len(response.stdout.splitlines()) == 6
+    assert response.stderr.strip().startswith('span')
+
+    profile = json.loads(profile_file.read_text())
+    assert set(profile['spans']) == {'list_local', 'listing'}
+    assert profile_file.with_suffix('.listing.prof').is_file()
+
+
+@pytest.mark.parametrize('command', ['list_local', 'list_public'])
+def test_list_import_time(setup, local_files, public_files, command):
+    # run in a separate interpreter, so that the modules imported by the other tests do not count
+    response = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                               'from isimip_publisher.main import main; main()', command, 'round/product/sector'],
+                              capture_output=True, text=True)
+    assert response.returncode == 0, response.stderr
+    assert len(response.stdout.splitlines()) == 6
+
+    # the lines look like "import time: <self us> | <cumulative us> | <module>", top-level modules are not indented
+    imports = {}
+    for line in response.stderr.splitlines():
+        if line.startswith('import time:'):
+            _, cumulative, module = line.removeprefix('import time:').split('|')
+            if cumulative.strip().isdigit():
+                imports[module.rstrip()] = int(cumulative)
+
+    for module in ['sqlalchemy', 'deepdiff', 'datacite', 'jsonschema', 'netCDF4', 'numpy', 'tqdm']:
+        assert module not in [name.strip() for name in imports], f'{module} is imported by {command}'
+
+    import_time = sum(cumulative for module, cumulative in imports.items() if not module.startswith(' ')) / 1e6
+    assert import_time < IMPORT_TIME_BUDGET, f'{command} imports took {import_time:.3f}s'
+
+
 def test_list_public(setup, public_files, script_runner):
     response = script_runner.run(['isimip-publisher', 'list_public', 'round/product/sector'])
     assert response.success, response.stderr
@@ -246,6 +289,18 @@ def test_write_public_jsons(setup, public_files, script_runner):
     assert response.stderr.strip().startswith('write_public_jsons')
 
 
+def test_write_public_jsons_unchanged(setup, public_files, script_runner):
+    response = script_runner.run(['isimip-publisher', 'write_public_jsons', 'round/product/sector'])
+    assert response.success, response.stderr
+
+    json_paths = sorted((Path(os.getenv('ISIMIP_PUBLIC_DIR')) / 'round/product/sector').rglob('*.json'))
+    mtimes = [json_path.stat().st_mtime_ns for json_path in json_paths]
+
+    response = script_runner.run(['isimip-publisher', 'write_public_jsons', 'round/product/sector'])
+    assert response.success, response.stderr
+    assert [json_path.stat().st_mtime_ns for json_path in json_paths] == mtimes
+
+
 def test_write_link_jsons(setup, public_links, script_runner):
     response = script_runner.run(['isimip-publisher', 'write_link_jsons',
                                   'round/product/sector/model', 'round/product/sector2/model'])
@@ -261,6 +316,20 @@ def test_insert_datasets(setup, local_files, db, script_runner):
     assert response.stderr.strip().startswith('insert_datasets')
 
 
+def test_insert_datasets_twice(setup, local_files, db, script_runner):
+    for _ in range(2):
+        response = script_runner.run(['isimip-publisher', 'insert_datasets', 'round/product/sector'])
+        assert response.success, response.stderr
+
+    # the second run does not insert the datasets and files again
+    session = init_database_session(os.getenv('ISIMIP_DATABASE'))
+    assert session.query(Dataset).count() == 2
+    assert session.query(File).count() == 6
+    assert session.query(File).filter(File.netcdf_header == None).count() == 0  # noqa: E711
+    assert session.query(File).filter(File.header_hash == None).count() == 0  # noqa: E711
+    session.close()
+
+
 def test_link_links(setup, remote_links, script_runner):
     response = script_runner.run(['isimip-publisher', 'link_links',
                                   'round/product/sector/model', 'round/product/sector2/model'])
@@ -285,6 +354,24 @@ def test_link_datasets(setup, public_links, script_runner):
     assert response.stderr.strip().startswith('link_datasets')
 
 
+def test_link_datasets_twice(setup, public_links, db, public_datasets, script_runner):
+    for _ in range(2):
+        response = script_runner.run(['isimip-publisher', 'link_datasets',
+                                      'round/product/sector/model', 'round/product/sector2/model'])
+        assert response.success, response.stderr
+
+    # the links are inserted once and point to the datasets and files of the target
+    session = init_database_session(os.getenv('ISIMIP_DATABASE'))
+    links = session.query(Dataset).filter(Dataset.path.startswith('round/product/sector2/')).all()
+    assert len(links) == 2
+    for link in links:
+        assert link.public
+        assert link.target.path == link.path.replace('sector2', 'sector')
+        assert len(link.files) == 3
+        assert all(file.target.path == file.path.replace('sector2', 'sector') for file in link.files)
+    session.close()
+
+
 def test_publish_datasets(setup, local_files, db, local_datasets, script_runner):
     response = script_runner.run(['isimip-publisher', 'publish_datasets', 'round/product/sector'])
     assert response.success, response.stderr
@@ -299,6 +386,49 @@ def test_update_datasets(setup, public_files, db, public_datasets, script_runner
     assert response.stderr.strip().startswith('update_datasets')
 
 
+def test_update_datasets_unchanged(setup, public_files, db, public_datasets, script_runner):
+    session = init_database_session(os.getenv('ISIMIP_DATABASE'))
+    dataset = session.query(Dataset).filter(Dataset.path.startswith('round/product/sector/model/model_lorem')).one()
+    dataset.specifiers = {**dataset.specifiers, 'alpha': 'changed'}
+    session.commit()
+
+    response = script_runner.run(['isimip-publisher', 'update_datasets', 'round/product/sector'])
+    assert response.success, response.stderr
+
+    # only the changed dataset is updated, the other rows keep updated = NULL
+    session.expire_all()
+    assert [dataset.path for dataset in session.query(Dataset).filter(Dataset.updated != None)] == [  # noqa: E711
+        'round/product/sector/model/model_lorem_dolor_sit_amet_var_global_monthly'
+    ]
+    assert session.query(Dataset).filter(Dataset.specifiers['alpha'].astext == 'changed').count() == 0
+    session.close()
+
+
+def test_archive_datasets_files(setup, public_files, db, mocker, public_datasets, script_runner):
+    mocker.patch('builtins.input', return_value='yes')
+
+    base_path = Path(__file__).parent.parent.parent
+    public_path = base_path / 'testing' / os.getenv('ISIMIP_PUBLIC_DIR')
+    archive_path = base_path / 'testing' / os.getenv('ISIMIP_ARCHIVE_DIR')
+    shutil.rmtree(archive_path, ignore_errors=True)
+
+    response = script_runner.run(['isimip-publisher', 'archive_datasets', 'round/product/sector/model'])
+    assert response.success, response.stderr
+
+    # the files and json files are moved to the archive, using the version of the dataset
+    session = init_database_session(os.getenv('ISIMIP_DATABASE'))
+    datasets = session.query(Dataset).filter(Dataset.path.startswith('round/product/sector/model/')).all()
+    assert datasets
+    for dataset in datasets:
+        assert not dataset.public
+        assert dataset.archived
+        for file in dataset.files:
+            assert not (public_path / file.path).exists()
+            assert (archive_path / dataset.version / file.path).is_file()
+            assert (archive_path / dataset.version / file.path).with_suffix('.json').is_file()
+    session.close()
+
+
 def test_archive_datasets_yes(setup, db, mocker, public_datasets, script_runner):
     mocker.patch('builtins.input', return_value='yes')
 
@@ -324,6 +454,41 @@ def test_check(setup, public_files, db, public_datasets, script_runner):
     assert not response.stderr
 
 
+def test_check_sample_since(setup, public_files, db, public_datasets, script_runner):
+    response = script_runner.run(['isimip-publisher', '--sample', '0.5', '--since', '2000-01-01',
+                                  'check', 'round/product/sector/model'])
+    assert response.success, response.stderr
+    assert not response.stdout
+    assert not response.stderr
+
+
+@pytest.mark.parametrize('sample', ['0', '-0.5', '1.5', 'nan', 'abc'])
+def test_check_sample_invalid(setup, sample, script_runner):
+    response = script_runner.run(['isimip-publisher', '--sample', sample, 'check', 'round/product/sector/model'])
+    assert response.returncode == 2
+    assert '--sample' in response.stderr
+
+
+def test_check_since_timezone(setup, public_files, db, public_datasets, script_runner):
+    response = script_runner.run(['isimip-publisher', '--since', '2000-01-01T00:00:00+00:00',
+                                  'check', 'round/product/sector/model'])
+    assert response.success, response.stderr
+    assert not response.stdout
+    assert not response.stderr
+
+
+def test_check_orphans(setup, public_files, db, public_datasets, script_runner):
+    base_path = Path(__file__).parent.parent.parent
+    public_path = base_path / 'testing' / os.getenv('ISIMIP_PUBLIC_DIR')
+    for file_path in (public_path / 'round/product/sector/model').glob('model_ipsum_*'):
+        file_path.unlink()
+
+    response = script_runner.run(['isimip-publisher', 'check', 'round/product/sector/model'])
+    assert response.success, response.stderr
+    assert 'is not on the file system' in response.stdout
+    assert not response.stderr
+
+
 def test_update_tree(setup, db, public_datasets, script_runner):
     response = script_runner.run(['isimip-publisher', 'update_tree', 'round/product/sector/model'])
     assert response.success, response.stderr
@@ -360,6 +525,18 @@ def test_insert_doi(setup, db, public_datasets, script_runner):
     assert not response.stderr
 
 
+def test_insert_doi_check_doi(setup, db, public_datasets, script_runner):
+    response = script_runner.run(['isimip-publisher', '--skip-registration', 'insert_doi',
+                                  'testing/resources/test.json', 'round/product/sector/model'])
+    assert response.success, response.stderr
+
+    # all files are now covered by the resource
+    response = script_runner.run(['isimip-publisher', 'check_doi', 'round/product/sector/model'])
+    assert response.success, response.stderr
+    assert not response.stdout
+    assert not response.stderr
+
+
 def test_update_doi(setup, db, public_datasets, resources, script_runner):
     response = script_runner.run(['isimip-publisher', '--skip-registration', 'update_doi',
                                   'testing/resources/test1.json'])
@@ -375,6 +552,14 @@ def test_check_doi(setup, db, public_datasets, script_runner):
     assert not response.stderr
 
 
+def test_check_doi_max_queries_per_file(setup, db, public_datasets, script_runner):
+    response = script_runner.run(['isimip-publisher', '--log-level', 'WARN', '--max-queries-per-file', '0.1',
+                                  'check_doi', 'round/product/sector/model'])
+    assert response.success, response.stderr
+    assert 'exceeds' in response.stdout
+    assert not response.stderr
+
+
 def test_check_doi_with_resources(setup, db, public_datasets, resources, script_runner):
     response = script_runner.run(['isimip-publisher', 'check_doi', 'round/product/sector/model'])
     assert response.success, response.stderr
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Query
+
+from isimip_publisher.utils.database import (
+    Dataset,
+    check_file_ids,
+    filter_path,
+    get_header_hash,
+    retrieve_datasets_by_specifiers,
+)
+
+
+def test_get_header_hash():
+    header = {
+        'dimensions': {
+            'lon': 720,
+            'lat': 360
+        },
+        'variables': {
+            'var': {
+                'missing_value': 1e20,
+                'flag_values': [1.0, 'NaN'],
+                '_FillValue': float(np.float32(1e20)),
+                'valid_max': float(np.float32(3.4e38)),
+                'flag': True
+            }
+        }
+    }
+
+    # the header as it is returned from JSONB, with a different key order and numeric types
+    stored_header = {
+        'variables': {
+            'var': {
+                'flag': True,
+                'flag_values': [1, 'NaN'],
+                'missing_value': 100000000000000000000,
+                '_FillValue': 100000002004087730000,
+                'valid_max': 339999995214436420000000000000000000000
+            }
+        },
+        'dimensions': {
+            'lat': 360,
+            'lon': 720
+        }
+    }
+
+    assert get_header_hash(header) == get_header_hash(stored_header)
+    assert get_header_hash(header) != get_header_hash({**header, 'dimensions': {'lon': 720, 'lat': 180}})
+    assert get_header_hash(None) is None
+
+
+def test_filter_path():
+    statement = filter_path(Dataset.path, 'round/product/sector_1/').compile(dialect=postgresql.dialect())
+    assert statement.params == {
+        'path_1': 'round/product/sector_1',
+        'path_2': 'round/product/sector\\_1/%'
+    }
+
+
+def test_retrieve_datasets_by_specifiers(mocker):
+    # return the query instead of executing it
+    mocker.patch.object(Query, 'all', autospec=True, side_effect=lambda query: query)
+    session = mocker.Mock()
+    session.query.side_effect = Query
+
+    query = retrieve_datasets_by_specifiers(session, {'model': ['model', 'x'], 'sector': 'sector'},
+                                            identifiers=['model'])
+    statement = query.statement.compile(dialect=postgresql.dialect())
+
+    assert str(statement).count('datasets.specifiers @>') == 3
+    assert 'datasets.identifiers @>' in str(statement)
+    assert 'datasets.public = true' in str(statement)
+    assert [value for value in statement.params.values() if isinstance(value, dict)] == [
+        {'model': 'model'}, {'model': 'x'}, {'sector': 'sector'}
+    ]
+
+
+def test_check_file_ids(mocker):
+    session = mocker.Mock()
+    session.query.return_value.filter.return_value = [('id-2',)]
+
+    files = [
+        mocker.Mock(uuid=None, path='round/file_1.nc'),
+        mocker.Mock(uuid='id-2', path='round/file_2.nc'),
+        mocker.Mock(uuid='id-3', path='round/file_3.nc')
+    ]
+    with pytest.raises(RuntimeError, match=r'File round/file_2\.nc has an id which already exists'):
+        check_file_ids(session, files)
+
+    # the ids of all files are checked using one query
+    session.query.return_value.filter.assert_called_once()
@@ -0,0 +1,157 @@
+import os
+
+import numpy as np
+import pytest
+
+from isimip_publisher.utils.files import clean_header, filter_links, get_digest, link_files, move_files
+from isimip_publisher.utils.json import write_json_file
+
+
+def test_clean_header():
+    header = {
+        'dimensions': {
+            'lon': 720,
+            'time': 0
+        },
+        'variables': {
+            'var': {
+                'missing_value': 1e20,
+                '_FillValue': float('nan'),
+                'valid_range': [0.0, float('inf')],
+                'flag_values': [1.0, float('nan')],
+                'scale_factor': float('-inf'),
+                'dimensions': ['time', 'lat', 'lon']
+            },
+            'lat': {
+                'actual_range': np.array([-89.75, np.nan]),
+                'valid_range': np.array([-np.inf, 90.0]),
+                'flag_values': np.array([1, 2], dtype='i2')
+            }
+        },
+        'global_attributes': {
+            'title': 'test'
+        }
+    }
+
+    assert clean_header(header) == {
+        'dimensions': {
+            'lon': 720,
+            'time': 0
+        },
+        'variables': {
+            'var': {
+                'missing_value': 1e20,
+                '_FillValue': 'NaN',
+                'flag_values': [1.0, 'NaN'],
+                'dimensions': ['time', 'lat', 'lon']
+            },
+            'lat': {
+                'actual_range': [-89.75, 'NaN'],
+                'flag_values': [1, 2]
+            }
+        },
+        'global_attributes': {
+            'title': 'test'
+        }
+    }
+
+
+def test_get_digest():
+    files = [
+        ('round/product/sector/model/model_global_2000_2001.nc', 'a'),
+        ('round/product/sector/model/model_global_2001_2002.nc', 'b')
+    ]
+    links = [
+        ('round/product/sector/links/model_global_2001_2002.nc', 'b'),
+        ('round/product/sector/links/model_global_2000_2001.nc', 'a')
+    ]
+
+    assert get_digest(files) == get_digest(links)
+    assert get_digest(files) != get_digest(files[:1])
+
+
+def test_write_json_file(tmp_path):
+    abspath = tmp_path / 'file.nc'
+    data = {'missing_value': 1e20, 'flag_values': [1.0, float('nan')]}
+
+    assert write_json_file(abspath, data)
+    assert (tmp_path / 'file.json').read_text() == \
+        '{\n  "missing_value": 1e+20,\n  "flag_values": [\n    1.0,\n    NaN\n  ]\n}'
+
+    # the file is not written again if the content did not change
+    assert not write_json_file(abspath, data)
+
+
+def test_move_files(tmp_path):
+    source_path = tmp_path / 'local' / 'round' / 'model'
+    source_path.mkdir(parents=True)
+    target_path = tmp_path / 'public' / 'round' / 'model'
+
+    file_paths = []
+    for i in range(25):
+        (source_path / f'file_{i}.nc').write_text(str(i))
+        file_paths.append((source_path / f'file_{i}.nc', target_path / f'file_{i}.nc'))
+
+    # the files of one directory are moved in several chunks
+    assert sum(move_files(file_paths, chunk_size=10)) == 25
+    assert sorted(path.name for path in target_path.iterdir()) == sorted(f'file_{i}.nc' for i in range(25))
+    assert not any(source_path.iterdir())
+    assert (target_path / 'file_3.nc').read_text() == '3'
+
+
+def test_move_files_missing(tmp_path):
+    file_paths = [(tmp_path / 'local' / 'missing.nc', tmp_path / 'public' / 'missing.nc')]
+
+    with pytest.raises(FileNotFoundError):
+        list(move_files(file_paths))
+
+    assert sum(move_files(file_paths, missing_ok=True)) == 1
+
+
+def test_move_files_different(tmp_path):
+    (tmp_path / 'local').mkdir()
+    (tmp_path / 'public').mkdir()
+    (tmp_path / 'local' / 'file.nc').write_text('new')
+    (tmp_path / 'public' / 'file.nc').write_text('old')
+
+    with pytest.raises(RuntimeError, match='different checksum'):
+        list(move_files([(tmp_path / 'local' / 'file.nc', tmp_path / 'public' / 'file.nc')]))
+
+
+def test_link_files(tmp_path):
+    target_path = tmp_path / 'round' / 'product' / 'sector' / 'model'
+    target_path.mkdir(parents=True)
+    for name in ['file_1.nc', 'file_2.nc']:
+        (target_path / name).write_text(name)
+
+    file_paths = [
+        'round/product/sector2/model/file_1.nc',
+        'round/product/sector2/model/file_2.nc'
+    ]
+    assert sum(link_files(tmp_path, 'round/product/sector', 'round/product/sector2', file_paths)) == 2
+
+    # the links are relative and point to the target files
+    link_path = tmp_path / 'round' / 'product' / 'sector2' / 'model' / 'file_1.nc'
+    assert link_path.is_symlink()
+    assert os.readlink(link_path) == '../../sector/model/file_1.nc'
+    assert link_path.read_text() == 'file_1.nc'
+
+    # existing links are skipped
+    assert sum(link_files(tmp_path, 'round/product/sector', 'round/product/sector2', file_paths)) == 2
+
+
+def test_filter_links(tmp_path):
+    target_path = tmp_path / 'round' / 'product' / 'sector' / 'model'
+    target_path.mkdir(parents=True)
+    (target_path / 'file_1.nc').write_text('')
+    (target_path / 'directory.nc').mkdir()
+
+    links = [
+        'round/product/sector2/model/file_1.nc',
+        'round/product/sector2/model/file_2.nc',
+        'round/product/sector2/model/directory.nc',
+        'round/product/sector2/missing/file_1.nc'
+    ]
+    assert filter_links(tmp_path, 'round/product/sector', 'round/product/sector2', links) == [
+        'round/product/sector2/model/file_1.nc'
+    ]
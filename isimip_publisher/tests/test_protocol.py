@@ -0,0 +1,74 @@
+import requests
+
+from isimip_publisher.utils.protocol import cache_json, get_json_paths, get_protocol_locations
+
+
+def get_response(mocker, status_code, content=b'', headers=None):
+    return mocker.Mock(status_code=status_code, content=content, headers=headers or {})
+
+
+def test_get_json_paths():
+    assert [path.as_posix() for path in get_json_paths('round/product/sector')] == [
+        'round/product/sector.json',
+        'round/product.json'
+    ]
+
+
+def test_cache_json(mocker, tmp_path):
+    url = 'https://protocol.isimip.org/pattern/round.json'
+    cache_path = tmp_path / 'pattern' / 'round.json'
+
+    get = mocker.patch('requests.get', return_value=get_response(mocker, 200, b'{}', {'ETag': '"1"'}))
+    assert cache_json(url, cache_path, ttl=3600)
+    assert cache_path.read_bytes() == b'{}'
+
+    # the file is fresh, no request is made
+    assert cache_json(url, cache_path, ttl=3600)
+    assert get.call_count == 1
+
+    # the file is stale and revalidated
+    get.return_value = get_response(mocker, 304)
+    assert cache_json(url, cache_path, ttl=0)
+    assert get.call_args.kwargs['headers'] == {'If-None-Match': '"1"'}
+    assert cache_path.read_bytes() == b'{}'
+
+    # the protocol can not be reached, the cached file is used
+    get.side_effect = requests.exceptions.ConnectionError
+    assert cache_json(url, cache_path, ttl=0)
+
+    # offline mode does not make any requests
+    get.reset_mock()
+    assert cache_json(url, cache_path, offline=True)
+    assert not cache_json(url, tmp_path / 'pattern' / 'missing.json', offline=True)
+    get.assert_not_called()
+
+
+def test_cache_json_missing(mocker, tmp_path):
+    url = 'https://protocol.isimip.org/pattern/round.json'
+    cache_path = tmp_path / 'pattern' / 'round.json'
+    cache_path.parent.mkdir()
+    cache_path.write_bytes(b'{}')
+
+    mocker.patch('requests.get', return_value=get_response(mocker, 404))
+    assert not cache_json(url, cache_path, ttl=0)
+    assert not cache_path.exists()
+
+
+def test_get_protocol_locations(mocker, tmp_path):
+    local_location = tmp_path / 'local'
+    (local_location / 'output' / 'pattern' / 'round').mkdir(parents=True)
+    (local_location / 'output' / 'pattern' / 'round' / 'product.json').write_text('{}')
+
+    cache_json = mocker.patch('isimip_publisher.utils.protocol.cache_json', return_value=True)
+
+    # the url is not fetched, since the local location has the file
+    assert get_protocol_locations('round/product/sector', [local_location, 'https://protocol.isimip.org'],
+                                  'pattern', cache_dir=tmp_path / 'cache') == [local_location]
+    cache_json.assert_not_called()
+
+    # the second url is not fetched, since the first url has the file
+    locations = get_protocol_locations('round/product/sector', ['https://a.example.org', 'https://b.example.org'],
+                                       'pattern', cache_dir=tmp_path / 'cache')
+    assert len(locations) == 1
+    assert cache_json.call_args.args[0] == 'https://a.example.org/pattern/round/product/sector.json'
+
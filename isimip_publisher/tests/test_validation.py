@@ -0,0 +1,48 @@
+import jsonschema
+import pytest
+
+from isimip_publisher.utils.validation import get_validator, validate_specifiers
+
+schema = {
+    'type': 'object',
+    'properties': {
+        'specifiers': {
+            'type': 'object',
+            'required': ['model'],
+            'properties': {
+                'model': {'type': 'string', 'enum': ['lorem', 'ipsum']},
+                'start_year': {'type': 'number', 'minimum': 2000},
+                'flag': {'type': 'integer'}
+            }
+        }
+    }
+}
+
+
+def test_validate_specifiers():
+    validator, valid = get_validator(schema)
+    assert get_validator(schema)[0] is validator
+
+    validate_specifiers(schema, {'model': 'lorem', 'start_year': 2000})
+    validate_specifiers(schema, {'model': 'lorem', 'start_year': 2000})
+    assert valid == {frozenset({('model', str, 'lorem'), ('start_year', int, 2000)})}
+
+    with pytest.raises(jsonschema.exceptions.ValidationError):
+        validate_specifiers(schema, {'model': 'dolor', 'start_year': 2000})
+
+    with pytest.raises(jsonschema.exceptions.ValidationError):
+        validate_specifiers(schema, {'model': 'lorem', 'start_year': 1999})
+
+    assert len(valid) == 1
+
+
+def test_validate_specifiers_types():
+    validate_specifiers(schema, {'model': 'lorem', 'flag': 1})
+
+    # True == 1, but a boolean is not an integer for the schema
+    with pytest.raises(jsonschema.exceptions.ValidationError):
+        validate_specifiers(schema, {'model': 'lorem', 'flag': True})
+
+    with pytest.raises(jsonschema.exceptions.ValidationError):
+        validate_specifiers(schema, {'model': 'lorem', 'flag': 1.5})
+
@@ -1,8 +1,10 @@
+import hashlib
+import json
 import logging
 import re
+import time
 import warnings
 from datetime import datetime
-from math import isnan
 from pathlib import Path
 from uuid import uuid4
 
@@ -17,17 +19,34 @@ from sqlalchemy import (
     String,
     Table,
     Text,
+    any_,
+    cast,
     create_engine,
+    event,
     func,
     inspect,
+    literal,
+    or_,
+    select,
     text,
+    update,
+    values,
 )
-from sqlalchemy.dialects.postgresql import ARRAY, JSONB, TSVECTOR, UUID
-from sqlalchemy.orm import backref, declarative_base, relationship, sessionmaker
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, TSVECTOR, UUID, insert
+from sqlalchemy.orm import backref, declarative_base, deferred, relationship, selectinload, sessionmaker
 from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.sql import column
 
+try:
+    from sqlalchemy.dialects.postgresql import distinct_on
+except ImportError:
+    # SQLAlchemy < 2.1, where Query.distinct(*columns) is used for DISTINCT ON instead
+    distinct_on = None
+
 from .dois import get_doi, get_title
+from .files import get_digest
+from .profiling import profiler, timed
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +63,23 @@ resources_datasets = Table('resources_datasets', Base.metadata,
 class Dataset(Base):
 
     __tablename__ = 'datasets'
+    __table_args__ = (
+        # text_pattern_ops allows prefix queries (LIKE 'path/%') to use the index regardless of the collation,
+        # these indexes are only created by init for existing tables, see create_concurrent_indexes
+        Index('datasets_path_pattern_idx', 'path', postgresql_ops={'path': 'text_pattern_ops'},
+              info={'concurrently': True}),
+        Index('datasets_tree_path_pattern_idx', 'tree_path', postgresql_ops={'tree_path': 'text_pattern_ops'},
+              info={'concurrently': True}),
+        # the unique index is needed for INSERT ... ON CONFLICT (path, version)
+        Index('datasets_path_version_idx', 'path', 'version', unique=True, info={'concurrently': True}),
+        # most queries only consider the public datasets
+        Index('datasets_public_path_idx', 'path', postgresql_ops={'path': 'text_pattern_ops'},
+              postgresql_where=text('public'), info={'concurrently': True}),
+        # jsonb_path_ops supports only the containment operator @>, but is smaller and faster than jsonb_ops
+        Index('datasets_specifiers_idx', 'specifiers', postgresql_using='gin',
+              postgresql_ops={'specifiers': 'jsonb_path_ops'}, info={'concurrently': True}),
+        Index('datasets_identifiers_idx', 'identifiers', postgresql_using='gin', info={'concurrently': True}),
+    )
 
     id = Column(UUID, nullable=False, primary_key=True, default=lambda: uuid4().hex)
     target_id = Column(UUID, ForeignKey('datasets.id'), nullable=True)
@@ -69,6 +105,8 @@ class Dataset(Base):
     published = Column(DateTime)
     archived = Column(DateTime)
 
+    digest = Column(Text, nullable=True)
+
     def __repr__(self):
         return str(self.id)
 
@@ -76,6 +114,16 @@ class Dataset(Base):
 class File(Base):
 
     __tablename__ = 'files'
+    __table_args__ = (
+        Index('files_path_pattern_idx', 'path', postgresql_ops={'path': 'text_pattern_ops'},
+              info={'concurrently': True}),
+        Index('files_path_version_idx', 'path', 'version', unique=True, info={'concurrently': True}),
+        Index('files_specifiers_idx', 'specifiers', postgresql_using='gin',
+              postgresql_ops={'specifiers': 'jsonb_path_ops'}, info={'concurrently': True}),
+        Index('files_identifiers_idx', 'identifiers', postgresql_using='gin', info={'concurrently': True}),
+        # used to reuse the headers of files with the same checksum, see retrieve_netcdf_headers
+        Index('ix_files_checksum', 'checksum', info={'concurrently': True}),
+    )
 
     id = Column(UUID, nullable=False, primary_key=True, default=lambda: uuid4().hex)
     dataset_id = Column(UUID, ForeignKey('datasets.id'))
@@ -87,13 +135,15 @@ class File(Base):
     size = Column(BigInteger, nullable=False)
     checksum = Column(Text, nullable=False)
     checksum_type = Column(Text, nullable=False)
-    netcdf_header = Column(JSONB, nullable=True)
+    netcdf_header = deferred(Column(JSONB, nullable=True))
     specifiers = Column(JSONB, nullable=False)
     identifiers = Column(ARRAY(Text), nullable=False)
 
     created = Column(DateTime)
     updated = Column(DateTime)
 
+    header_hash = Column(Text, nullable=True)
+
     dataset = relationship('Dataset', back_populates='files')
     links = relationship('File', backref=backref('target', remote_side=id))
 
@@ -156,16 +206,114 @@ class Search(Base):
         return str(self.dataset_id)
 
 
-def init_database_session(database_settings):
+@timed('database')
+def init_database_session(database_settings, check_columns=True):
     engine = create_engine(database_settings)
 
+    # count the queries, rows and time for each statement
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
     Base.metadata.create_all(engine)
+    if check_columns:
+        check_missing_columns(engine)
+    create_indexes(engine)
 
     Session = sessionmaker(bind=engine)
     session = Session()
     return session
 
 
+def get_missing_columns(engine):
+    # fetch the columns of all tables with a single query and return the columns of the models which are missing
+    with engine.connect() as connection:
+        rows = connection.execute(text('''
+            SELECT table_name, column_name FROM information_schema.columns
+            WHERE table_schema = current_schema()
+        ''')).all()
+    existing_columns = set(rows)
+    return [
+        table_column
+        for table in Base.metadata.sorted_tables
+        for table_column in table.columns
+        if (table.name, table_column.name) not in existing_columns
+    ]
+
+
+def create_columns(engine):
+    # create_all does not add new (nullable) columns to existing tables, so they are added by init
+    for table_column in get_missing_columns(engine):
+        logger.info('add column %s.%s', table_column.table.name, table_column.name)
+        with engine.begin() as connection:
+            connection.execute(text(f'ALTER TABLE {table_column.table.name} ADD COLUMN {table_column.name} '
+                                    f'{table_column.type.compile(engine.dialect)}'))
+
+
+def check_missing_columns(engine):
+    # the columns which were added to the models later are created by init, not on every session start
+    missing_columns = get_missing_columns(engine)
+    if missing_columns:
+        raise RuntimeError('Some columns are missing ({}), please run "isimip-publisher init" first'.format(
+            ', '.join(f'{table_column.table.name}.{table_column.name}' for table_column in missing_columns)
+        ))
+
+
+def create_indexes(engine):
+    # create_all does not create indexes for existing tables, so they are created here,
+    # except for the indexes on large tables, which are created by create_concurrent_indexes
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if not index.info.get('concurrently'):
+                index.create(engine, checkfirst=True)
+
+
+def create_concurrent_indexes(engine):
+    # CREATE INDEX CONCURRENTLY does not lock the table for writes, but can not run inside a transaction
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.info.get('concurrently'):
+                    logger.info('create index %s', index.name)
+                    postgresql_options = index.dialect_options['postgresql']
+                    postgresql_options['concurrently'] = True
+                    try:
+                        connection.execute(CreateIndex(index, if_not_exists=True))
+                    finally:
+                        postgresql_options['concurrently'] = False
+
+
+def check_unique_indexes(session):
+    # INSERT ... ON CONFLICT (path, version) needs the unique indexes, which are created by init for existing
+    # tables, the result is stored in the session, so that the check runs only once
+    if not session.info.get('unique_indexes'):
+        count = session.execute(text('''
+            SELECT COUNT(*) FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+            WHERE pg_class.relname IN ('datasets_path_version_idx', 'files_path_version_idx')
+            AND pg_index.indisvalid
+        ''')).scalar_one()
+        if count < 2:
+            raise RuntimeError('The unique indexes on (path, version) are missing or invalid,'
+                               ' please run "isimip-publisher init" first')
+        session.info['unique_indexes'] = True
+
+
+def filter_path(column, path):
+    # match the path itself and everything below it, but not e.g. sector2 for sector, the wildcards
+    # in the path are escaped, so that the whole path is used for the range scan on the pattern index
+    path = str(path).rstrip('/')
+    like_path = re.sub(r'([\\%_])', r'\\\1', path) + '/%'
+    return or_(column == path, column.like(like_path))
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    profiler.record_query(statement, cursor.rowcount, duration)
+
+
 def get_search_terms(dataset):
     terms = list(dataset.specifiers.values())
     terms += search_terms_split_pattern.split(str(dataset.id))
@@ -202,27 +350,15 @@ def get_search_vector(dataset):
     return func.setweight(func.to_tsvector(search_string), 'A')
 
 
+@timed('database')
 def insert_dataset(session, version, rights, restricted, name, path, size, specifiers):
-    # check if the dataset with this version is already in the database
-    dataset = session.query(Dataset).filter(
-        Dataset.path == path,
-        Dataset.version == version
-    ).one_or_none()
+    # insert a new row for this dataset, unless a dataset with the same path and version is already in the
+    # database, the unique index on (path, version) makes this safe for concurrent publishers
+    check_unique_indexes(session)
 
-    if dataset:
-        logger.debug('skip dataset %s', path)
-        if dataset.target is not None:
-            raise RuntimeError(f'Dataset {path} is already stored, but with a target')
-        if dataset.rights != rights:
-            raise RuntimeError(f'Dataset {path} is already stored, but with different rights')
-        if dataset.name != name:
-            raise RuntimeError(f'Dataset {path} is already stored, but with different name')
-        if dataset.specifiers != specifiers:
-            raise RuntimeError(f'Dataset {path} is already stored, but with different specifiers')
-    else:
-        # insert a new row for this dataset
-        logger.debug('insert dataset %s', path)
-        dataset = Dataset(
+    dataset = session.scalars(
+        insert(Dataset).values(
+            id=uuid4().hex,
             name=name,
             path=path,
             version=version,
@@ -233,10 +369,32 @@ def insert_dataset(session, version, rights, restricted, name, path, size, speci
             public=False,
             restricted=restricted,
             created=datetime.utcnow()
-        )
-        session.add(dataset)
+        ).on_conflict_do_nothing(index_elements=['path', 'version']).returning(Dataset)
+    ).one_or_none()
+
+    if dataset:
+        logger.debug('insert dataset %s', path)
+    else:
+        # check the dataset which is already stored
+        dataset = session.query(Dataset).filter(
+            Dataset.path == path,
+            Dataset.version == version
+        ).one()
+
+        logger.debug('skip dataset %s', path)
+        if dataset.target_id is not None:
+            raise RuntimeError(f'Dataset {path} is already stored, but with a target')
+        if dataset.rights != rights:
+            raise RuntimeError(f'Dataset {path} is already stored, but with different rights')
+        if dataset.name != name:
+            raise RuntimeError(f'Dataset {path} is already stored, but with different name')
+        if dataset.specifiers != specifiers:
+            raise RuntimeError(f'Dataset {path} is already stored, but with different specifiers')
+
+    return dataset
 
 
+@timed('database')
 def publish_dataset(session, version, path):
     # check that there is no public dataset with the same path
     public_dataset = session.query(Dataset).filter(
@@ -262,116 +420,144 @@ def publish_dataset(session, version, path):
     dataset.published = datetime.utcnow()
 
 
-def update_dataset(session, rights, restricted, path, specifiers):
-    # check if the dataset is already in the database
-    dataset = session.query(Dataset).filter(
-        Dataset.path == path,
-        Dataset.public == True  # noqa: E712
-    ).one_or_none()
-
-    if dataset is None:
-        raise RuntimeError(f'No public dataset with the path {path} found.')
-
-    if dataset.target:
-        if dataset.target.rights != rights:
-            raise RuntimeError(f'Target dataset {dataset.target.path} was found, but with different rights')
-
-    # update the dataset
-    logger.debug('update dataset %s', path)
-
-    # update rights and restricted on all links
-    if dataset.rights != rights:
-        dataset.rights = rights
-        for link in dataset.links:
-            link.rights = rights
-
-    if dataset.restricted != restricted:
-        dataset.restricted = restricted
-        for link in dataset.links:
-            link.restricted = restricted
-
-    dataset.specifiers = specifiers
-    dataset.identifiers = list(specifiers.keys())
-    dataset.updated = datetime.utcnow()
-
-
-def insert_dataset_link(session, rights, restricted, target_dataset_path, name, path, size, specifiers):
-    # get the target_dataset
-    target_dataset = session.query(Dataset).filter(
-        Dataset.path == target_dataset_path,
-        Dataset.public == True  # noqa: E712
-    ).one_or_none()
-
-    if target_dataset is None:
-        raise RuntimeError(f'No public target dataset for the path {target_dataset_path} found')
-
-    # get the version from the target dataset
-    version = target_dataset.version
-
-    if target_dataset.rights != rights:
-        raise RuntimeError(f'Target dataset {target_dataset_path}#{version} was found, but with different rights')
-    if target_dataset.name != name:
-        raise RuntimeError(f'Target dataset {target_dataset_path}#{version} was found, but with a different name')
-    if target_dataset.size != size:
-        raise RuntimeError(f'Target dataset {target_dataset_path}#{version} was found, but with a different size')
+@timed('database')
+def update_datasets(session, rights, restricted, datasets, chunk_size=1000):
+    # bulk version of update_dataset and update_file: the datasets and files are fetched in a few queries
+    # and only the rows which actually changed are updated using UPDATE ... FROM (VALUES ...)
+    db_datasets = {
+        db_dataset.path: db_dataset for db_dataset in query_in_chunks(
+            session.query(Dataset).filter(Dataset.public == True),  # noqa: E712
+            Dataset.path, [dataset.path for dataset in datasets], chunk_size
+        )
+    }
 
-    # check if the dataset with this version is already in the database
-    dataset = session.query(Dataset).filter(
-        Dataset.path == path,
-        Dataset.version == version
-    ).one_or_none()
+    target_datasets = {
+        target_dataset.id: target_dataset for target_dataset in query_in_chunks(
+            session.query(Dataset), Dataset.id,
+            [db_dataset.target_id for db_dataset in db_datasets.values() if db_dataset.target_id], chunk_size
+        )
+    }
 
-    if dataset:
-        logger.debug('skip dataset link %s', path)
-        if dataset.target != target_dataset:
-            raise RuntimeError(f'Dataset link {path} is already stored, but with a different target')
-        if dataset.rights != rights:
-            raise RuntimeError(f'Dataset link {path} is already stored, but with different rights')
-        if dataset.name != name:
-            raise RuntimeError(f'Dataset link {path} is already stored, but with a different name')
-        if dataset.specifiers != specifiers:
-            raise RuntimeError(f'Dataset link {path} is already stored, but with different specifiers')
-    else:
-        # insert a new row for this dataset
-        logger.debug('insert dataset %s', path)
-        dataset = Dataset(
-            name=name,
-            path=path,
-            version=version,
-            size=size,
-            rights=rights,
-            specifiers=specifiers,
-            identifiers=list(specifiers.keys()),
-            public=True,
-            restricted=restricted,
-            target=target_dataset,
-            created=datetime.utcnow()
+    db_files = {
+        (db_file.dataset_id, db_file.path): db_file for db_file in query_in_chunks(
+            session.query(File.id, File.dataset_id, File.path, File.specifiers), File.dataset_id,
+            [db_dataset.id for db_dataset in db_datasets.values()], chunk_size
         )
-        session.add(dataset)
+    }
 
+    now = datetime.utcnow()
+    dataset_rows = []
+    file_rows = []
+    link_target_ids = set()
+    for dataset in datasets:
+        db_dataset = db_datasets.get(dataset.path)
+
+        if db_dataset is None:
+            raise RuntimeError(f'No public dataset with the path {dataset.path} found.')
+
+        target_dataset = target_datasets.get(db_dataset.target_id)
+        if target_dataset is not None and target_dataset.rights != rights:
+            raise RuntimeError(f'Target dataset {target_dataset.path} was found, but with different rights')
+
+        # rights and restricted are updated on all links as well
+        if db_dataset.rights != rights or db_dataset.restricted != restricted:
+            link_target_ids.add(db_dataset.id)
+
+        if db_dataset.rights != rights or db_dataset.restricted != restricted \
+                or db_dataset.specifiers != dataset.specifiers:
+            logger.debug('update dataset %s', dataset.path)
+            dataset_rows.append({
+                'id': db_dataset.id,
+                'rights': rights,
+                'restricted': restricted,
+                'specifiers': dataset.specifiers,
+                'identifiers': list(dataset.specifiers.keys()),
+                'updated': now
+            })
+
+        for file in dataset.files:
+            db_file = db_files.get((db_dataset.id, file.path))
+
+            if db_file is None:
+                raise RuntimeError(f'No file with the path {file.path} found in dataset {dataset.path}')
+
+            if db_file.specifiers != file.specifiers:
+                logger.debug('update file %s', file.path)
+                file_rows.append({
+                    'id': db_file.id,
+                    'specifiers': file.specifiers,
+                    'identifiers': list(file.specifiers.keys()),
+                    'updated': now
+                })
+
+    link_rows = [
+        {'id': link_id, 'rights': rights, 'restricted': restricted}
+        for link_id, link_rights, link_restricted in query_in_chunks(
+            session.query(Dataset.id, Dataset.rights, Dataset.restricted), Dataset.target_id,
+            link_target_ids, chunk_size
+        )
+        if link_rights != rights or link_restricted != restricted
+    ]
+
+    update_from_values(session, Dataset, dataset_rows, chunk_size)
+    update_from_values(session, Dataset, link_rows, chunk_size)
+    update_from_values(session, File, file_rows, chunk_size)
+
+
+def update_from_values(session, model, rows, chunk_size=1000):
+    # update the rows (with the same keys) using a join on the id with a VALUES list
+    table = model.__table__
+    if rows:
+        names = list(rows[0].keys())
+        for i in range(0, len(rows), chunk_size):
+            data = values(*[column(name, table.c[name].type) for name in names], name='data').data(
+                [tuple(row[name] for name in names) for row in rows[i:i + chunk_size]]
+            )
+            session.execute(
+                update(table)
+                .where(table.c.id == cast(data.c.id, table.c.id.type))
+                .values({name: cast(data.c[name], table.c[name].type) for name in names if name != 'id'})
+            )
+
+
+@timed('database')
+def update_dataset_digest(session, dataset):
+    # compute the digest from the files which are stored for this dataset (after they were inserted)
+    session.flush()
+    files = session.query(File.path, File.checksum).filter(File.dataset_id == dataset.id).all()
+    dataset.digest = get_digest(files)
+    return dataset.digest
+
+
+@timed('database')
+def archive_datasets(session, paths):
+    # mark the public versions of these datasets archived using a single statement
+    logger.debug('unpublish %d datasets', len(paths))
+    rows = session.execute(
+        update(Dataset)
+        .where(Dataset.path.in_(paths), Dataset.public == True)  # noqa: E712
+        .values(public=False, archived=datetime.utcnow())
+        .returning(Dataset.path, Dataset.version)
+    ).all()
+    return dict(rows)
 
-def archive_dataset(session, path):
-    # find the public version of this dataset
-    public_dataset = session.query(Dataset).filter(
-        Dataset.path == path,
-        Dataset.public == True  # noqa: E712
-    ).one_or_none()
 
-    if public_dataset:
-        # mark this dataset archived
-        logger.debug('unpublish dataset %s', path)
-        public_dataset.public = False
-        public_dataset.archived = datetime.utcnow()
-        return public_dataset.version
+@timed('database')
+def retrieve_datasets(session, path, public=None, follow=False, like=True, links=False):
+    path = Path(path)
 
+    # load the files and the targets (for links) of all datasets upfront, instead of one query per dataset
+    db_datasets = session.query(Dataset).options(
+        selectinload(Dataset.files),
+        selectinload(Dataset.target).selectinload(Dataset.files)
+    )
 
-def retrieve_datasets(session, path, public=None, follow=False, like=True):
-    path = Path(path)
-    db_datasets = session.query(Dataset)
+    # optionally, load the links of the datasets and their files as well (e.g. for archive_datasets)
+    if links:
+        db_datasets = db_datasets.options(selectinload(Dataset.links).selectinload(Dataset.files))
 
     if like:
-        like_path = path.as_posix() + '/%'
-        db_datasets = db_datasets.filter(Dataset.path.like(like_path))
+        db_datasets = db_datasets.filter(filter_path(Dataset.path, path.as_posix()))
     else:
         db_datasets = db_datasets.join(Dataset.files).filter(File.path == path.as_posix())
 
@@ -390,171 +576,379 @@ def retrieve_datasets(session, path, public=None, follow=False, like=True):
     for dataset in datasets:
         dataset.files = sorted(dataset.files, key=lambda f: f.path)
 
+    profiler.record_files(sum(len(dataset.files) for dataset in datasets))
+
     return datasets
 
 
-def check_file_id(session, path, uuid):
-    file = session.query(File).filter(File.id == uuid).one_or_none()
-    if file:
-        raise RuntimeError(f'File {path} has an id which already exists in the database ({uuid})')
+@timed('database')
+def retrieve_datasets_by_specifiers(session, specifiers, identifiers=None, public=True):
+    # filter the datasets using containment (@>), so that the gin indexes on specifiers and identifiers
+    # can be used, a list of values for a specifier matches any of the values
+    db_datasets = session.query(Dataset)
 
+    for identifier, value in specifiers.items():
+        values = value if isinstance(value, list) else [value]
+        db_datasets = db_datasets.filter(or_(*[Dataset.specifiers.contains({identifier: v}) for v in values]))
 
-def insert_file(session, version, dataset_path, uuid, name, path, size,
-                checksum, checksum_type, netcdf_header, specifiers):
-    # get the dataset from the database
-    dataset = session.query(Dataset).filter(
-        Dataset.path == dataset_path,
-        Dataset.version == version
-    ).one_or_none()
+    if identifiers:
+        db_datasets = db_datasets.filter(Dataset.identifiers.contains(identifiers))
 
-    if dataset is None:
-        raise RuntimeError(f'No dataset with the path {dataset_path} found')
+    if public:
+        db_datasets = db_datasets.filter(Dataset.public == True)  # noqa: E712
 
-    # check if the file is already in the database
-    file = session.query(File).filter(
-        File.path == path,
-        File.version == version
-    ).one_or_none()
+    return db_datasets.order_by(Dataset.path).all()
+
+
+@timed('database')
+def check_file_ids(session, files, chunk_size=1000):
+    # check the ids from the headers of all files at once, using one query for each chunk of ids
+    file_paths = {str(file.uuid): file.path for file in files if file.uuid}
+    for file_id, in query_in_chunks(session.query(File.id), File.id, file_paths.keys(), chunk_size):
+        raise RuntimeError(f'File {file_paths[file_id]} has an id which already exists in the database ({file_id})')
+
+
+@timed('database')
+def retrieve_netcdf_headers(session, files, chunk_size=1000):
+    # get the stored headers for files with the same checksum, chunked to keep the IN clause small,
+    # DISTINCT ON returns only one header for each checksum, even if many files share it
+    checksums = sorted({file.checksum for file in files})
+
+    headers = {}
+    for i in range(0, len(checksums), chunk_size):
+        query = session.query(File.checksum, File.checksum_type, File.netcdf_header).filter(
+            File.checksum.in_(checksums[i:i + chunk_size]),
+            File.netcdf_header.isnot(None)
+        )
+        if distinct_on is None:
+            query = query.distinct(File.checksum, File.checksum_type)
+        else:
+            query = query.ext(distinct_on(File.checksum, File.checksum_type))
+
+        rows = query.order_by(File.checksum, File.checksum_type)
+        for checksum, checksum_type, netcdf_header in rows:
+            headers[(checksum, checksum_type)] = netcdf_header
+
+    return headers
+
+
+@timed('database')
+def insert_files(session, version, dataset, files, chunk_size=1000):
+    # insert new rows for the files of a dataset in bulk, the files which are already in the database
+    # with the same path and version are skipped by ON CONFLICT and compared afterwards using one query
+    rows = {}
+    for file in files:
+        netcdf_header = file.cleaned_header
+        rows[file.path] = {
+            'id': file.uuid or uuid4().hex,
+            'name': file.name,
+            'path': file.path,
+            'version': version,
+            'size': file.size,
+            'checksum': file.checksum,
+            'checksum_type': file.checksum_type,
+            'netcdf_header': netcdf_header,
+            'header_hash': get_header_hash(netcdf_header),
+            'specifiers': file.specifiers,
+            'identifiers': list(file.specifiers.keys()),
+            'dataset_id': dataset.id,
+            'created': datetime.utcnow()
+        }
+
+    inserted_paths = insert_rows(session, File, list(rows.values()), chunk_size)
+    for path in inserted_paths:
+        logger.debug('insert file %s', path)
+
+    uuids = {file.path: file.uuid for file in files}
+    stored_files = query_in_chunks(session.query(File).filter(File.version == version), File.path,
+                                   [path for path in rows if path not in inserted_paths], chunk_size)
+    for stored_file in stored_files:
+        path, row = stored_file.path, rows[stored_file.path]
 
-    if file:
         logger.debug('skip file %s', path)
-        if uuid is not None and str(file.id) != uuid:
+        if uuids[path] is not None and str(stored_file.id) != uuids[path]:
             raise RuntimeError(f'File {path} is already stored with the same version, but a different id')
-        if file.name != name:
+        if stored_file.name != row['name']:
             raise RuntimeError(f'File {path} is already stored with the same version, but a different name')
-        if file.size != size:
+        if stored_file.size != row['size']:
             raise RuntimeError(f'File {path} is already stored with the same version, but a different size')
-        if file.checksum != checksum:
+        if stored_file.checksum != row['checksum']:
             raise RuntimeError(f'File {path} is already stored with the same version, but a different checksum')
-        if file.checksum_type != checksum_type:
+        if stored_file.checksum_type != row['checksum_type']:
             raise RuntimeError(f'File {path} is already stored with the same version, but a different checksum_type')
-        if DeepDiff(file.netcdf_header, netcdf_header, ignore_numeric_type_changes=True):
+        if diff_netcdf_header(stored_file, row['netcdf_header'], row['header_hash']):
             raise RuntimeError(f'File {path} is already stored with the same version, but a different netcdf_header')
-        if file.specifiers != specifiers:
+        if stored_file.specifiers != row['specifiers']:
             raise RuntimeError(f'File {path} is already stored with the same version, but different specifiers')
-    else:
-        # insert a new row for this file
-        logger.debug('insert file %s', path)
-        file = File(
-            id=uuid,
-            name=name,
-            path=path,
-            version=version,
-            size=size,
-            checksum=checksum,
-            checksum_type=checksum_type,
-            netcdf_header=clean_json(netcdf_header),
-            specifiers=specifiers,
-            identifiers=list(specifiers.keys()),
-            dataset=dataset,
-            created=datetime.utcnow()
-        )
-        session.add(file)
 
 
-def update_file(session, dataset_path, path, specifiers):
-    logger.info('update_file %s', path)
+def insert_rows(session, model, rows, chunk_size=1000):
+    # insert the rows in chunks, but skip the rows which conflict with stored rows with the same path and version,
+    # returns the paths of the rows which were actually inserted
+    check_unique_indexes(session)
+
+    inserted_paths = set()
+    for i in range(0, len(rows), chunk_size):
+        inserted_paths.update(session.execute(
+            insert(model).on_conflict_do_nothing(index_elements=['path', 'version']).returning(model.path),
+            rows[i:i + chunk_size]
+        ).scalars())
+    return inserted_paths
+
+
+@timed('database')
+def insert_links(session, rights, restricted, target_path, path, datasets, chunk_size=1000):
+    # bulk insert of dataset and file links: the target datasets and files are fetched in a few queries and
+    # validated in memory, the links are inserted at once and only the links which are already stored
+    # (with the same path and version) are fetched afterwards and compared
+    def get_target_path(link_path):
+        return str(target_path / Path(link_path).relative_to(path))
+
+    target_datasets = {
+        dataset.path: dataset for dataset in query_in_chunks(
+            session.query(Dataset).filter(Dataset.public == True),  # noqa: E712
+            Dataset.path, [get_target_path(dataset.path) for dataset in datasets], chunk_size
+        )
+    }
 
-    # get the dataset from the database
-    dataset = session.query(Dataset).filter(
-        Dataset.path == dataset_path,
-        Dataset.public == True  # noqa: E712
-    ).one_or_none()
+    dataset_rows = {}
+    for dataset in datasets:
+        target_dataset_path = get_target_path(dataset.path)
+        target_dataset = target_datasets.get(target_dataset_path)
+
+        if target_dataset is None:
+            raise RuntimeError(f'No public target dataset for the path {target_dataset_path} found')
+
+        # get the version from the target dataset
+        version = target_dataset.version
+
+        if target_dataset.rights != rights:
+            raise RuntimeError(f'Target dataset {target_dataset_path}#{version} was found, but with different rights')
+        if target_dataset.name != dataset.name:
+            raise RuntimeError(f'Target dataset {target_dataset_path}#{version} was found, but with a different name')
+        if target_dataset.size != dataset.size:
+            raise RuntimeError(f'Target dataset {target_dataset_path}#{version} was found, but with a different size')
+
+        dataset_rows[dataset.path] = {
+            'id': uuid4().hex,
+            'name': dataset.name,
+            'path': dataset.path,
+            'version': version,
+            'size': dataset.size,
+            'rights': rights,
+            'specifiers': dataset.specifiers,
+            'identifiers': list(dataset.specifiers.keys()),
+            'public': True,
+            'restricted': restricted,
+            'target_id': target_dataset.id,
+            'created': datetime.utcnow()
+        }
 
-    if dataset is None:
-        raise RuntimeError(f'No public dataset with the path {dataset_path} found')
+    inserted_paths = insert_rows(session, Dataset, list(dataset_rows.values()), chunk_size)
 
-    # check if the file is already in the database
-    file = session.query(File).filter(
-        File.path == path,
-        File.dataset == dataset
-    ).one_or_none()
+    link_dataset_ids = {}
+    for dataset in datasets:
+        if dataset.path in inserted_paths:
+            logger.debug('insert dataset %s', dataset.path)
+            row = dataset_rows[dataset.path]
+            link_dataset_ids[dataset.path] = (row['id'], row['target_id'], row['version'])
+
+    stored_datasets = {
+        (dataset.path, dataset.version): dataset for dataset in query_in_chunks(
+            session.query(Dataset), Dataset.path,
+            [dataset_path for dataset_path in dataset_rows if dataset_path not in inserted_paths], chunk_size
+        )
+    }
+    for dataset in datasets:
+        if dataset.path not in inserted_paths:
+            row = dataset_rows[dataset.path]
+            link_dataset = stored_datasets[(dataset.path, row['version'])]
+
+            logger.debug('skip dataset link %s', dataset.path)
+            if link_dataset.target_id != row['target_id']:
+                raise RuntimeError(f'Dataset link {dataset.path} is already stored, but with a different target')
+            if link_dataset.rights != rights:
+                raise RuntimeError(f'Dataset link {dataset.path} is already stored, but with different rights')
+            if link_dataset.name != dataset.name:
+                raise RuntimeError(f'Dataset link {dataset.path} is already stored, but with a different name')
+            if link_dataset.specifiers != dataset.specifiers:
+                raise RuntimeError(f'Dataset link {dataset.path} is already stored, but with different specifiers')
+
+            # the file links only need to be inserted (or checked) if the digest of the stored link is different
+            if link_dataset.digest != dataset.digest:
+                link_dataset_ids[dataset.path] = (link_dataset.id, row['target_id'], row['version'])
+
+    link_files = [file for dataset in datasets if dataset.path in link_dataset_ids for file in dataset.files]
+
+    target_files = {
+        file.path: file for file in query_in_chunks(
+            session.query(File).join(File.dataset).filter(Dataset.public == True),  # noqa: E712
+            File.path, [get_target_path(file.path) for file in link_files], chunk_size
+        )
+    }
+
+    file_rows = {}
+    for file in link_files:
+        target_file_path = get_target_path(file.path)
+        target_file = target_files.get(target_file_path)
+
+        if target_file is None:
+            raise RuntimeError(f'No public target file for the path {target_file_path} found')
+
+        # get the version from the target dataset
+        version = target_file.version
+
+        if target_file.name != file.name:
+            raise RuntimeError(f'Target file {target_file_path}#{version} was found, but with a different name')
+        if target_file.size != file.size:
+            raise RuntimeError(f'Target file {target_file_path}#{version} was found, but with a different size')
+        if target_file.checksum != file.checksum:
+            raise RuntimeError(f'Target file {target_file_path}#{version} was found, but with a different checksum')
+        if target_file.checksum_type != file.checksum_type:
+            raise RuntimeError(f'Target file {target_file_path}#{version} was found,'
+                               ' but with a different checksum_type')
+
+        dataset_id, target_dataset_id, dataset_version = link_dataset_ids[file.dataset.path]
+        if dataset_version != version or target_dataset_id != target_file.dataset_id:
+            raise RuntimeError(f'Dataset for file link does not match dataset for {file.path}')
+
+        netcdf_header = file.cleaned_header
+        file_rows[file.path] = {
+            'id': uuid4().hex,
+            'name': file.name,
+            'path': file.path,
+            'version': version,
+            'size': file.size,
+            'checksum': file.checksum,
+            'checksum_type': file.checksum_type,
+            'netcdf_header': netcdf_header,
+            'header_hash': get_header_hash(netcdf_header),
+            'specifiers': file.specifiers,
+            'identifiers': list(file.specifiers.keys()),
+            'dataset_id': dataset_id,
+            'target_id': target_file.id,
+            'created': datetime.utcnow()
+        }
+
+    inserted_paths = insert_rows(session, File, list(file_rows.values()), chunk_size)
+    for file_path in inserted_paths:
+        logger.debug('insert file %s', file_path)
 
-    if file:
-        logger.debug('update file %s', path)
-        file.specifiers = specifiers
-        file.identifiers = list(specifiers.keys())
-        file.updated = datetime.utcnow()
+    stored_files = {
+        (file.path, file.version): file for file in query_in_chunks(
+            session.query(File), File.path,
+            [file_path for file_path in file_rows if file_path not in inserted_paths], chunk_size
+        )
+    }
+    for file_path, row in file_rows.items():
+        if file_path not in inserted_paths:
+            stored_file = stored_files[(file_path, row['version'])]
+
+            logger.debug('skip file %s', file_path)
+            if stored_file.name != row['name']:
+                raise RuntimeError(f'File link {file_path} is already stored with the same version,'
+                                   ' but a different name')
+            if stored_file.size != row['size']:
+                raise RuntimeError(f'File link {file_path} is already stored with the same version,'
+                                   ' but a different size')
+            if stored_file.checksum != row['checksum']:
+                raise RuntimeError(f'File link {file_path} is already stored with the same version,'
+                                   ' but a different checksum')
+            if stored_file.checksum_type != row['checksum_type']:
+                raise RuntimeError(f'File link {file_path} is already stored with the same version,'
+                                   ' but a different checksum_type')
+            if diff_netcdf_header(stored_file, row['netcdf_header'], row['header_hash']):
+                raise RuntimeError(f'File link {file_path} is already stored with the same version,'
+                                   ' but a different netcdf_header')
+            if stored_file.specifiers != row['specifiers']:
+                raise RuntimeError(f'File link {file_path} is already stored with the same version,'
+                                   ' but different specifiers')
+
+    # update the digests of the dataset links from the stored files
+    dataset_files = {}
+    for dataset_id, file_path, checksum in query_in_chunks(
+        session.query(File.dataset_id, File.path, File.checksum), File.dataset_id,
+        [dataset_id for dataset_id, _, _ in link_dataset_ids.values()], chunk_size
+    ):
+        dataset_files.setdefault(dataset_id, []).append((file_path, checksum))
+
+    if dataset_files:
+        session.execute(update(Dataset), [
+            {'id': dataset_id, 'digest': get_digest(files)} for dataset_id, files in dataset_files.items()
+        ])
+
+
+def query_in_chunks(query, column, values, chunk_size=1000):
+    # filter the query using IN, chunked to keep the IN clause small
+    values = sorted(set(values))
+    for i in range(0, len(values), chunk_size):
+        yield from query.filter(column.in_(values[i:i + chunk_size]))
+
+
+def get_header_hash(netcdf_header):
+    # hash a canonical serialization of the (cleaned) header: the keys are sorted and all numbers are
+    # serialized as float, since JSONB preserves neither the key order nor the numeric types, e.g. the
+    # float32 1e20 is returned as the integer 100000002004087730000, which is the same float again
+    if netcdf_header is not None:
+        canonical_header = json.dumps(normalize_numbers(netcdf_header), sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical_header.encode()).hexdigest()
+
+
+def normalize_numbers(data):
+    if isinstance(data, dict):
+        return {key: normalize_numbers(value) for key, value in data.items()}
+    elif isinstance(data, list):
+        return [normalize_numbers(item) for item in data]
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        try:
+            return float(data)
+        except OverflowError:
+            return data
     else:
-        raise RuntimeError(f'No file with the path {path} found in dataset {dataset_path}')
+        return data
 
 
-def insert_file_link(session, target_file_path, dataset_path,
-                     name, path, size, checksum, checksum_type, netcdf_header, specifiers):
-    # get the target file
-    target_file = session.query(File).join(File.dataset).filter(
-        File.path == target_file_path,
-        Dataset.public == True  # noqa: E712
-    ).one_or_none()
+def diff_netcdf_header(file, netcdf_header, header_hash):
+    # compare the hashes and use DeepDiff only to explain a mismatch,
+    # the hash is computed (and stored) for rows which were inserted before it was introduced
+    if file.header_hash is None:
+        file.header_hash = get_header_hash(file.netcdf_header)
 
-    if target_file is None:
-        raise RuntimeError(f'No public target file for the path {target_file_path} found')
+    if file.header_hash != header_hash:
+        diff = DeepDiff(file.netcdf_header, netcdf_header, ignore_numeric_type_changes=True)
+        if diff:
+            logger.error('diff = %s', diff)
+        else:
+            # the stored hash was computed differently (e.g. by an older version), replace it
+            file.header_hash = header_hash
+        return diff
 
-    # get the version from the target dataset
-    version = target_file.version
 
-    if target_file.name != name:
-        raise RuntimeError(f'Target file {target_file_path}#{version} was found, but with a different name')
-    if target_file.size != size:
-        raise RuntimeError(f'Target file {target_file_path}#{version} was found, but with a different size')
-    if target_file.checksum != checksum:
-        raise RuntimeError(f'Target file {target_file_path}#{version} was found, but with a different checksum')
-    if target_file.checksum_type != checksum_type:
-        raise RuntimeError(f'Target file {target_file_path}#{version} was found, but with a different checksum_type')
+@timed('database')
+def update_header_hashes(session, chunk_size=1000):
+    # backfill the header_hash for files which were inserted before it was introduced
+    count = 0
+    while True:
+        rows = session.query(File.id, File.netcdf_header).filter(
+            File.header_hash.is_(None),
+            File.netcdf_header.isnot(None)
+        ).limit(chunk_size).all()
 
-    # get the linked dataset for this file from the database
-    dataset = session.query(Dataset).filter(
-        Dataset.path == dataset_path,
-        Dataset.version == version
-    ).one_or_none()
+        if not rows:
+            break
 
-    if dataset is None:
-        raise RuntimeError(f'No dataset with the path {dataset_path} found')
-    if dataset.target != target_file.dataset:
-        raise RuntimeError(f'Dataset for file link does not match dataset for {path}')
-
-    # check if the file is already in the database
-    file = session.query(File).filter(
-        File.path == path,
-        File.version == version
-    ).one_or_none()
+        session.execute(update(File), [
+            {'id': file_id, 'header_hash': get_header_hash(netcdf_header)} for file_id, netcdf_header in rows
+        ])
+        session.commit()
 
-    if file:
-        logger.debug('skip file %s', path)
-        if file.name != name:
-            raise RuntimeError(f'File link {path} is already stored with the same version, but a different name')
-        if file.size != size:
-            raise RuntimeError(f'File link {path} is already stored with the same version, but a different size')
-        if file.checksum != checksum:
-            raise RuntimeError(f'File link {path} is already stored with the same version, but a different checksum')
-        if file.checksum_type != checksum_type:
-            raise RuntimeError(f'File link {path} is already stored with the same version,'
-                                ' but a different checksum_type')
-        if DeepDiff(file.netcdf_header, netcdf_header, ignore_numeric_type_changes=True):
-            raise RuntimeError(f'File link {path} is already stored with the same version,'
-                                ' but a different netcdf_header')
-        if file.specifiers != specifiers:
-            raise RuntimeError(f'File link {path} is already stored with the same version, but different specifiers')
-    else:
-        # insert a new row for this file
-        logger.debug('insert file %s', path)
-        file = File(
-            name=name,
-            path=path,
-            version=version,
-            size=size,
-            checksum=checksum,
-            checksum_type=checksum_type,
-            netcdf_header=clean_json(netcdf_header),
-            specifiers=specifiers,
-            identifiers=list(specifiers.keys()),
-            dataset=dataset,
-            target=target_file,
-            created=datetime.utcnow()
-        )
-        session.add(file)
+        count += len(rows)
+        logger.info('update header_hash for %d files', count)
 
+    return count
 
+
+@timed('database')
 def insert_resource(session, datacite, paths, datacite_prefix):
     doi = get_doi(datacite)
     title = get_title(datacite)
@@ -577,15 +971,6 @@ def insert_resource(session, datacite, paths, datacite_prefix):
     if not paths:
         raise RuntimeError(f'No paths were provided for {doi}.')
 
-    # gather datasets, use a set to remove duplicate datasets (for links)
-    datasets = set()
-    for path in paths:
-        datasets.update(retrieve_datasets(session, path, public=True, follow=True))
-
-    if not datasets:
-        message = f'No datasets found for {doi}.'
-        warnings.warn(RuntimeWarning(message), stacklevel=2)
-
     # insert a new resource
     logger.debug('insert resource %s', doi)
     resource = Resource(
@@ -602,15 +987,65 @@ def insert_resource(session, datacite, paths, datacite_prefix):
     else:
         resource.datacite = {}
 
-    # add the datasets as many to many relation
-    for dataset in datasets:
-        resource.datasets.append(dataset)
-
     session.add(resource)
+    session.flush()
+
+    # add the public datasets below the paths as many to many relation using a single INSERT ... SELECT,
+    # links are replaced by their targets and DISTINCT removes the duplicates
+    dataset_ids = session.scalars(
+        insert(resources_datasets).from_select(
+            ['resource_id', 'dataset_id'],
+            select(
+                literal(resource.id, type_=resources_datasets.c.resource_id.type),
+                func.coalesce(Dataset.target_id, Dataset.id)
+            ).where(
+                or_(*[filter_path(Dataset.path, Path(path).as_posix()) for path in paths]),
+                Dataset.public == True  # noqa: E712
+            ).distinct()
+        ).returning(resources_datasets.c.dataset_id)
+    ).all()
+
+    if not dataset_ids:
+        message = f'No datasets found for {doi}.'
+        warnings.warn(RuntimeWarning(message), stacklevel=2)
+
+    logger.debug('add %d datasets to resource %s', len(dataset_ids), doi)
 
     return resource
 
 
+@timed('database')
+def retrieve_uncovered_file_paths(session, path, public=None, chunk_size=1000):
+    conditions = [filter_path(Dataset.path, path)]
+    if public:
+        conditions.append(Dataset.public == public)
+
+    if session.query(Dataset.id).filter(*conditions).first() is None:
+        raise RuntimeError(f'no dataset found for {path}')
+
+    # a dataset is covered if a path of one of its resources (or of the resources of its target, for links)
+    # is a prefix (^@) of the path of the dataset, the paths of the files of all other datasets are streamed
+    covered = select(resources_datasets.c.dataset_id).join(
+        Resource, Resource.id == resources_datasets.c.resource_id
+    ).where(
+        resources_datasets.c.dataset_id == func.coalesce(Dataset.target_id, Dataset.id),
+        Dataset.path.op('^@')(any_(Resource.paths))
+    ).exists()
+
+    query = select(File.path).join(Dataset, File.dataset_id == Dataset.id).where(
+        *conditions,
+        ~covered
+    ).order_by(Dataset.path, File.path).execution_options(yield_per=chunk_size)
+
+    count = 0
+    for file_path in session.scalars(query):
+        count += 1
+        yield file_path
+
+    profiler.record_files(count)
+
+
+@timed('database')
 def update_resource(session, datacite):
     doi = get_doi(datacite)
     title = get_title(datacite)
@@ -638,6 +1073,7 @@ def update_resource(session, datacite):
     return resource
 
 
+@timed('database')
 def fetch_resource(session, doi):
     # look for the resource in the database
     resource = session.query(Resource).filter(
@@ -650,15 +1086,15 @@ def fetch_resource(session, doi):
     return resource
 
 
+@timed('tree')
 def update_tree(session, path, tree):
     # check if path is a file
     if Path(path).suffix:
         path = Path(path).parent.as_posix()
 
     # step 1: get the public datasets for this path
-    like_path = f'{path}%'
     datasets = session.query(Dataset).filter(
-        Dataset.path.like(like_path),
+        filter_path(Dataset.path, path),
         Dataset.public == True  # noqa: E712
     ).all()
 
@@ -724,6 +1160,7 @@ def build_tree_dict(tree_dict, tree_path, identifiers, specifiers):
             return build_tree_dict(tree_dict[specifier]['items'], tree_path, identifiers[1:], specifiers)
 
 
+@timed('tree')
 def clean_tree(session):
     # step 1: get the tree
     database_tree = session.query(Tree).one_or_none()
@@ -764,15 +1201,15 @@ def build_clean_tree_dict(tree_dict, clean_tree_dict, specifiers):
     return clean_tree_dict
 
 
+@timed('search')
 def update_search(session, path):
     # check if path is a file
     if Path(path).suffix:
         path = Path(path).parent.as_posix()
 
     # step 1: get the all datasets for this path
-    like_path = f'{path}%'
     datasets = session.query(Dataset).filter(
-        Dataset.path.like(like_path)
+        filter_path(Dataset.path, path)
     ).all()
 
     for dataset in datasets:
@@ -785,6 +1222,33 @@ def update_search(session, path):
             create_or_update_search(session, link)
 
 
+@timed('search')
+def update_resource_search(session, resource, chunk_size=1000):
+    # only the search vectors of the datasets of this resource and of their links contain the
+    # title, doi, and creators of the resource, all other datasets are not affected
+    dataset_ids = session.scalars(
+        select(resources_datasets.c.dataset_id).where(resources_datasets.c.resource_id == resource.id)
+    ).all()
+
+    query = session.query(Dataset).options(
+        selectinload(Dataset.search),
+        selectinload(Dataset.resources),
+        selectinload(Dataset.target).selectinload(Dataset.resources),
+        selectinload(Dataset.target).selectinload(Dataset.links).selectinload(Dataset.resources),
+        selectinload(Dataset.links).selectinload(Dataset.resources)
+    )
+
+    datasets = {}
+    for id_column in [Dataset.id, Dataset.target_id]:
+        for dataset in query_in_chunks(query, id_column, dataset_ids, chunk_size):
+            datasets[dataset.id] = dataset
+
+    for dataset in datasets.values():
+        create_or_update_search(session, dataset)
+
+    logger.debug('update search for %d datasets', len(datasets))
+
+
 def create_or_update_search(session, dataset):
     if dataset.search is None:
         dataset.search = Search(
@@ -798,6 +1262,7 @@ def create_or_update_search(session, dataset):
         dataset.search.updated = datetime.utcnow()
 
 
+@timed('views')
 def update_views(session):
     update_identifiers_view(session)
     update_specifiers_view(session)
@@ -853,13 +1318,3 @@ def get_materialized_view_names(session):
         # for SQLAlchemy < 2
         return inspect(engine).get_view_names()
 
-
-def clean_json(data):
-    if isinstance(data, list):
-        return [clean_json(item) for item in data]
-    elif isinstance(data, dict):
-        return {key: clean_json(value) for key, value in data.items()}
-    elif isinstance(data, float) and isnan(data):
-        return 'NaN'
-    else:
-        return data
@@ -1,17 +1,21 @@
+import hashlib
 import logging
 import os
 import shutil
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from math import isinf, isnan
 from pathlib import Path
 
 from isimip_utils.checksum import get_checksum
-from isimip_utils.netcdf import open_dataset_write, update_global_attributes
 
 from ..config import settings
+from .profiling import timed
 
 logger = logging.getLogger(__name__)
 
 
+@timed('listing')
 def list_files(base_path, path, remote_dest=None, suffix=None, find_type='f'):
     abs_path = base_path / path
 
@@ -57,14 +61,27 @@ def list_all(base_path, path, remote_dest=None, suffix=None):
 
 
 def filter_links(public_path, target_path, path, links):
+    # keep only the links which point to a regular file, each target directory is listed only once
+    # instead of checking every target file separately
+    target_names = {}
     filtered_links = []
     for link_path in links:
         target_abspath = public_path / target_path / Path(link_path).relative_to(path)
-        if target_abspath.exists() and not target_abspath.is_symlink():
+        if target_abspath.parent not in target_names:
+            target_names[target_abspath.parent] = list_file_names(target_abspath.parent)
+        if target_abspath.name in target_names[target_abspath.parent]:
             filtered_links.append(link_path)
     return filtered_links
 
 
+def list_file_names(abs_path):
+    try:
+        with os.scandir(abs_path) as entries:
+            return {entry.name for entry in entries if entry.is_file(follow_symlinks=False)}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+
 def copy_files(remote_dest, remote_path, local_path, path, datasets):
     # check if path is a file
     if Path(path).suffix:
@@ -114,7 +131,52 @@ def copy_files(remote_dest, remote_path, local_path, path, datasets):
         os.remove(include_file)
 
 
-def move_file(source_path, target_path, keep=False):
+def move_files(file_paths, workers=None, missing_ok=False, chunk_size=10):
+    # group the files by their target directory, so that each directory is created and checked only once,
+    # the files of a directory are moved in parallel chunks and the directory is synced after its last chunk
+    directories = {}
+    for source_path, target_path in file_paths:
+        directories.setdefault(target_path.parent, []).append((source_path, target_path))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        pending_chunks = {}
+        for directory, directory_file_paths in directories.items():
+            directory.mkdir(parents=True, exist_ok=True)
+            target_device = directory.stat().st_dev
+
+            for i in range(0, len(directory_file_paths), chunk_size):
+                chunk = directory_file_paths[i:i + chunk_size]
+                futures[executor.submit(move_chunk_files, target_device, chunk, missing_ok)] = (directory, chunk)
+                pending_chunks[directory] = pending_chunks.get(directory, 0) + 1
+
+        for future in as_completed(futures):
+            future.result()
+
+            directory, chunk = futures[future]
+            pending_chunks[directory] -= 1
+            if pending_chunks[directory] == 0:
+                # sync the directory once, after all files were renamed
+                sync_directory(directory)
+
+            yield len(chunk)  # yield increment for the progress bar
+
+
+def move_chunk_files(target_device, file_paths, missing_ok=False):
+    source_devices = {}
+    for source_path, target_path in file_paths:
+        try:
+            # check once per source directory if the files can be renamed or need to be copied
+            if source_path.parent not in source_devices:
+                source_devices[source_path.parent] = source_path.parent.stat().st_dev
+
+            transfer_file(source_path, target_path, source_devices[source_path.parent] == target_device)
+        except FileNotFoundError:
+            if not missing_ok:
+                raise
+
+
+def transfer_file(source_path, target_path, same_device):
     logger.info('move_file %s', source_path)
 
     # check if the file is already public
@@ -123,30 +185,90 @@ def move_file(source_path, target_path, keep=False):
         if get_checksum(source_path) != get_checksum(target_path):
             raise RuntimeError(f'The file {source_path} already exists and has a different checksum than {target_path}')
 
-    # create the directories for the file
-    target_path.parent.mkdir(parents=True, exist_ok=True)
-
-    # copy the file
-    if keep:
-        logger.debug('cp %s %s', source_path, target_path)
-        shutil.copy(source_path, target_path)
-    else:
+    if same_device:
+        # on the same file system, moving the file is only a metadata operation
         logger.debug('mv %s %s', source_path, target_path)
-        shutil.move(source_path, target_path)
+        os.rename(source_path, target_path)
+    elif source_path.is_symlink():
+        # symlinks are created again on the other file system
+        logger.debug('ln -s %s %s', os.readlink(source_path), target_path)
+        target_path.unlink(missing_ok=True)
+        os.symlink(os.readlink(source_path), target_path)
+        os.remove(source_path)
+    else:
+        logger.debug('cp %s %s', source_path, target_path)
+        copy_file(source_path, target_path)
+        os.remove(source_path)
+
+
+def copy_file(source_path, target_path):
+    # copy to a temporary file in the same directory, sync and rename it,
+    # so that the target file is never partially written
+    tmp_path = target_path.with_name(f'.{target_path.name}.{os.getpid()}.tmp')
+    with open(source_path, 'rb') as source_file, open(tmp_path, 'wb') as tmp_file:
+        try:
+            # copy_file_range copies the data in the kernel (or even on the storage)
+            size = os.fstat(source_file.fileno()).st_size
+            while tmp_file.tell() < size:
+                if not os.copy_file_range(source_file.fileno(), tmp_file.fileno(), size - tmp_file.tell()):
+                    break
+        except (AttributeError, OSError):
+            # copy_file_range is not available on all platforms and for all combinations of file systems
+            source_file.seek(0)
+            tmp_file.seek(0)
+            tmp_file.truncate()
+            shutil.copyfileobj(source_file, tmp_file)
+
+        os.fsync(tmp_file.fileno())
+
+    shutil.copystat(source_path, tmp_path)
+    os.replace(tmp_path, target_path)
+
+
+def sync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 
+def link_files(public_path, target_path, link_path, file_paths, workers=None):
+    # group the links by their directory, so that each directory is created, opened and the relative
+    # path to the target directory is computed only once, the directories are processed in parallel
+    directories = {}
+    for file_path in file_paths:
+        directories.setdefault(Path(file_path).parent, []).append(Path(file_path).name)
 
-def link_file(public_path, target_path, link_path, file_path):
-    link_abspath = public_path / file_path
-    target_abspath = public_path / target_path / Path(file_path).relative_to(link_path)
-    relative_path = os.path.relpath(target_abspath, link_abspath.parent)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for directory, file_names in directories.items():
+            link_abspath = public_path / directory
+            target_abspath = public_path / target_path / directory.relative_to(link_path)
+            relative_path = Path(os.path.relpath(target_abspath, link_abspath))
 
-    link_abspath.parent.mkdir(parents=True, exist_ok=True)
+            futures[executor.submit(create_symlinks, link_abspath, relative_path, file_names)] = file_names
 
-    logger.debug('ln -s %s %s', relative_path, link_abspath)
+        for future in as_completed(futures):
+            future.result()
+            yield len(futures[future])  # yield increment for the progress bar
+
+
+def create_symlinks(link_abspath, relative_path, file_names):
+    link_abspath.mkdir(parents=True, exist_ok=True)
+
+    # the symlinks are created relative to an open file descriptor of the directory, which is only
+    # open while this directory is processed, so that the number of open file descriptors stays small
+    dir_fd = os.open(link_abspath, os.O_RDONLY | os.O_DIRECTORY)
     try:
-        os.symlink(relative_path, link_abspath)
-    except FileExistsError:
-        pass
+        for file_name in file_names:
+            logger.debug('ln -s %s %s', relative_path / file_name, link_abspath / file_name)
+            try:
+                os.symlink(relative_path / file_name, file_name, dir_fd=dir_fd)
+            except FileExistsError:
+                pass
+    finally:
+        os.close(dir_fd)
 
 
 def delete_file(abs_path):
@@ -171,6 +293,8 @@ def mock_file(mock_path):
     shutil.copyfile(empty_file, mock_path)
 
     if mock_path.suffix.startswith('.nc'):
+        from isimip_utils.netcdf import open_dataset_write, update_global_attributes
+
         with open_dataset_write(mock_path) as dataset:
             update_global_attributes(dataset, {
                 'path': mock_path
@@ -179,19 +303,135 @@ def mock_file(mock_path):
         mock_path.write_text('path: ' + mock_path.as_posix() + os.linesep)
 
 
+def read_netcdf_header(abspath):
+    from isimip_utils.netcdf import get_dimensions, get_global_attributes, get_variables, open_dataset_read
+
+    with open_dataset_read(abspath) as dataset:
+        return {
+            'dimensions': get_dimensions(dataset),
+            'variables': get_variables(dataset, convert=True),
+            'global_attributes': get_global_attributes(dataset, convert=True)
+        }
+
+
+@timed('checksum')
+def compute_checksums(files, workers=None):
+    # hashlib releases the GIL, so that threads can be used
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(lambda file: file.checksum, files):
+            pass
+
+
+def get_digest(files):
+    # compute a digest over the sorted (name, checksum) pairs of the files of a dataset, the names
+    # are used instead of the paths, so that a dataset link has the same digest as its target dataset
+    digest = hashlib.sha256()
+    for file_name, checksum in sorted((Path(path).name, checksum) for path, checksum in files):
+        digest.update(f'{file_name}\t{checksum}\n'.encode())
+    return digest.hexdigest()
+
+
+@timed('header')
+def read_netcdf_headers(files, headers=None, workers=None):
+    # only consider netcdf files, for which the (cached) header was not yet read
+    files = [file for file in files
+             if Path(file.path).suffix.startswith('.nc') and not file.netcdf_header_read]
+
+    # reuse the headers of byte-identical files, e.g. from the database
+    if headers:
+        read_files = []
+        for file in files:
+            header = headers.get((file.checksum, file.checksum_type))
+            if header is None:
+                read_files.append(file)
+            else:
+                logger.debug('reuse_netcdf_header %s', file.path)
+                file.netcdf_header = header
+        files = read_files
+
+    if len(files) < 2 or workers == 1:
+        for file in files:
+            file.netcdf_header = read_netcdf_header(file.abspath)
+    else:
+        # netCDF4/HDF5 is not thread-safe, so processes are used
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            abspaths = [file.abspath for file in files]
+            chunksize = max(1, len(abspaths) // (4 * (workers or os.cpu_count())))
+            for file, header in zip(files, executor.map(read_netcdf_header, abspaths, chunksize=chunksize),
+                                    strict=True):
+                file.netcdf_header = header
+
+
 def clean_header(header):
-    # remove key/value pairs with NaN, Inf or -Inf from the header recursively,
-    # since they cannot be stored in a JSONB database field
-    special_values = {float('NaN'), float('Inf'), float('-Inf')}
+    # prepare the header for a JSONB database field in a single (iterative) pass:
+    # key/value pairs with Inf or -Inf (also in lists) are removed and NaN is replaced by 'NaN'
+    import numpy as np
+
     cleaned_header = {}
-    for key, value in header.items():
-        if isinstance(value, dict):
-            cleaned_header[key] = clean_header(value)
-        elif isinstance(value, list):
-            if not special_values.intersection(value):
-                cleaned_header[key] = value
-        else:
-            if value not in special_values:
-                cleaned_header[key] = value
+    stack = [(header, cleaned_header)]
+    while stack:
+        values, cleaned_values = stack.pop()
+        for key, value in values.items():
+            if isinstance(value, dict):
+                # the dict is added now to keep the order of the keys and filled later
+                cleaned_values[key] = {}
+                stack.append((value, cleaned_values[key]))
+            elif isinstance(value, np.ndarray):
+                cleaned_value = clean_array(value)
+                if cleaned_value is not None:
+                    cleaned_values[key] = cleaned_value
+            elif isinstance(value, list):
+                cleaned_value = clean_list(value)
+                if cleaned_value is not None:
+                    cleaned_values[key] = cleaned_value
+            else:
+                if isinstance(value, np.generic):
+                    value = value.item()
+                if isinstance(value, float):
+                    if isnan(value):
+                        cleaned_values[key] = 'NaN'
+                    elif not isinf(value):
+                        cleaned_values[key] = value
+                else:
+                    cleaned_values[key] = value
 
     return cleaned_header
+
+
+def clean_list(values):
+    # return None if the list contains Inf or -Inf, replace NaN by 'NaN' otherwise
+    cleaned_values = []
+    for value in values:
+        if isinstance(value, float):
+            if isnan(value):
+                value = 'NaN'
+            elif isinf(value):
+                return None
+        elif isinstance(value, list | dict):
+            value = clean_json(value)
+        cleaned_values.append(value)
+    return cleaned_values
+
+
+def clean_array(values):
+    # numeric arrays (e.g. attributes from netCDF) are checked using NumPy
+    import numpy as np
+
+    if values.dtype.kind == 'f':
+        if np.isinf(values).any():
+            return None
+        elif np.isnan(values).any():
+            return ['NaN' if isnan(value) else value for value in values.tolist()]
+    return values.tolist()
+
+
+def clean_json(data):
+    # replace NaN by 'NaN' within lists, Inf and -Inf are kept here
+    if isinstance(data, list):
+        return [clean_json(item) for item in data]
+    elif isinstance(data, dict):
+        return {key: clean_json(value) for key, value in data.items()}
+    elif isinstance(data, float) and isnan(data):
+        return 'NaN'
+    else:
+        return data
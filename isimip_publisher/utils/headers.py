@@ -0,0 +1,65 @@
+import atexit
+import logging
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import threading
+import zlib
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class HeaderStore:
+    # a key/value store for the netcdf headers in a temporary sqlite database, so that the headers of
+    # all files do not need to be kept in memory between the stages of a command, e.g. in run
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connection = None
+        self.path = None
+        self.pid = None
+
+    def connect(self):
+        # the database is only created when the first header is stored
+        if self.connection is None:
+            self.path = Path(tempfile.mkdtemp(prefix='isimip-publisher-'))
+            self.pid = os.getpid()
+            logger.debug('header_store %s', self.path)
+
+            self.connection = sqlite3.connect(self.path / 'headers.sqlite3', isolation_level=None,
+                                              check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode = OFF')
+            self.connection.execute('PRAGMA synchronous = OFF')
+            self.connection.execute('CREATE TABLE headers (key INTEGER, field TEXT, value BLOB, '
+                                    'PRIMARY KEY (key, field))')
+            atexit.register(self.close)
+
+        return self.connection
+
+    def get(self, key, field):
+        with self.lock:
+            row = self.connect().execute('SELECT value FROM headers WHERE key = ? AND field = ?',
+                                         (key, field)).fetchone()
+        if row is not None:
+            return pickle.loads(zlib.decompress(row[0]))
+
+    def set(self, key, field, value):
+        data = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), 1)
+        with self.lock:
+            self.connect().execute('INSERT OR REPLACE INTO headers VALUES (?, ?, ?)', (key, field, data))
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+                # forked worker processes must not remove the database of the parent process
+                if self.pid == os.getpid():
+                    shutil.rmtree(self.path, ignore_errors=True)
+
+
+header_store = HeaderStore()
@@ -1,14 +1,50 @@
 import json as python_json
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+from .profiling import timed
+
 logger = logging.getLogger(__name__)
 
 
+@timed('json')
 def write_json_file(abspath, data):
     json_path = Path(abspath).with_suffix('.json')
+    content = python_json.dumps(data, indent=2).encode()
+
+    # skip the file if it exists with the same content, compare the size first to avoid the read
+    try:
+        if json_path.stat().st_size == len(content) and json_path.read_bytes() == content:
+            logger.debug('skip_json_file %s', json_path)
+            return False
+    except FileNotFoundError:
+        pass
 
     logger.info('write_json_file %s', json_path)
 
-    with open(json_path, 'w') as f:
-        f.write(python_json.dumps(data, indent=2))
+    # write to a temporary file in the same directory and rename it,
+    # so that the json file is never partially written
+    tmp_path = json_path.with_name(f'.{json_path.name}.{os.getpid()}.tmp')
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, json_path)
+    return True
+
+
+def write_json_files(files, workers=None):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for file in files:
+            # the header is read in the main thread, since netCDF4/HDF5 is not thread-safe,
+            # the checksum, the serialization and the writing are done in the workers
+            file.netcdf_header  # noqa: B018
+            futures.append(executor.submit(write_file_json, file))
+
+        for future in as_completed(futures):
+            future.result()
+            yield 1  # yield increment for the progress bar
+
+
+def write_file_json(file):
+    return write_json_file(file.abspath, file.json)
@@ -5,10 +5,15 @@ from isimip_utils.patterns import match_dataset_path, match_file_path
 from isimip_utils.utils import exclude_path, include_path
 
 from ..models import Dataset, File
+from .profiling import profiler, timed
 
 logger = logging.getLogger(__name__)
 
+# interned specifier keys and values, so that equal specifiers of different files share the same objects
+specifier_values = {}
 
+
+@timed('matching')
 def match_datasets(pattern, base_path, files, include=None, exclude=None):
     dataset_dict = {}
 
@@ -27,7 +32,7 @@ def match_datasets(pattern, base_path, files, include=None, exclude=None):
                 dataset_dict[dataset_path] = Dataset(
                     name=dataset_path.name,
                     path=dataset_path.as_posix(),
-                    specifiers=dataset_specifiers
+                    specifiers=intern_specifiers(dataset_specifiers)
                 )
 
     # second path: add files to datasets
@@ -55,10 +60,9 @@ def match_datasets(pattern, base_path, files, include=None, exclude=None):
                 # append file to dataset
                 dataset_dict[dataset_path].files.append(File(
                     dataset=dataset_dict[dataset_path],
-                    name=file_path.name,
                     path=file_path.as_posix(),
                     abspath=file_abspath.as_posix(),
-                    specifiers=file_specifiers
+                    specifiers=intern_specifiers(file_specifiers)
                 ))
 
             else:
@@ -71,9 +75,24 @@ def match_datasets(pattern, base_path, files, include=None, exclude=None):
     for dataset in dataset_list:
         dataset.files = sorted(dataset.files, key=lambda file: file.path)
 
+    profiler.record_files(sum(len(dataset.files) for dataset in dataset_list))
+
     return dataset_list
 
 
+def intern_specifiers(specifiers):
+    return {intern_value(key): intern_value(value) for key, value in specifiers.items()}
+
+
+def intern_value(value):
+    # the type is part of the key, so that e.g. 1 and 1.0 are not mixed up
+    try:
+        return specifier_values.setdefault((type(value), value), value)
+    except TypeError:
+        return value  # unhashable values, e.g. lists
+
+
+@timed('matching')
 def filter_datasets(db_datasets, include=None, exclude=None):
     datasets = []
     for db_dataset in db_datasets:
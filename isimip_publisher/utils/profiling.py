@@ -0,0 +1,211 @@
+import cProfile
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+parameter_pattern = re.compile(r'%\(\w+\)s')
+parameter_list_pattern = re.compile(r'\?(, \?)+')
+whitespace_pattern = re.compile(r'\s+')
+
+STAGES = [
+    'listing',
+    'matching',
+    'validation',
+    'checksum',
+    'header',
+    'json',
+    'database',
+    'tree',
+    'search',
+    'views'
+]
+
+
+class Profiler:
+
+    def __init__(self):
+        self.enabled = False
+        self.stage = None
+        self.spans = {}
+        self.cprofile = None
+        self.start = None
+
+        # spans can be used from worker threads, the active spans are tracked per thread
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        # the queries are recorded even if the profiler is not enabled
+        self.queries = {}
+        self.commands = {}
+        self.files = 0
+        self.depth = 0
+
+    def enable(self, stage=None):
+        self.enabled = True
+        self.stage = stage
+        self.spans = {}
+        self.cprofile = cProfile.Profile() if stage is not None else None
+        self.start = time.perf_counter()
+        self.queries = {}
+        self.commands = {}
+
+    def disable(self):
+        self.enabled = False
+
+    @property
+    def active(self):
+        if not hasattr(self.local, 'active'):
+            self.local.active = []
+        return self.local.active
+
+    @contextmanager
+    def span(self, name):
+        # spans with the same name are not nested, e.g. list_links calls list_files
+        if not self.enabled or name in self.active:
+            yield
+            return
+
+        # cProfile only works reliably for the main thread
+        cprofile = name == self.stage and threading.current_thread() is threading.main_thread()
+
+        self.active.append(name)
+        if cprofile:
+            self.cprofile.enable()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                span = self.spans.setdefault(name, {'calls': 0, 'time': 0.0})
+                span['calls'] += 1
+                span['time'] += time.perf_counter() - start
+
+            if cprofile:
+                self.cprofile.disable()
+            self.active.pop()
+
+    @contextmanager
+    def command(self, name, max_queries_per_file=None):
+        # nested commands (e.g. in run) start with the files of the enclosing command,
+        # since they might use the datasets from the store instead of matching them again
+        files = self.files if self.depth else 0
+        calls, rows, duration = self.count_queries()
+
+        self.files = files
+        self.depth += 1
+        try:
+            with self.span(name):
+                yield
+        finally:
+            self.depth -= 1
+
+        end_calls, end_rows, end_duration = self.count_queries()
+        command = {
+            'queries': end_calls - calls,
+            'rows': end_rows - rows,
+            'time': end_duration - duration,
+            'files': self.files
+        }
+        self.commands[name] = command
+
+        if command['queries']:
+            logger.info('%s: %d queries, %d rows, %.3fs for %d files', name,
+                        command['queries'], command['rows'], command['time'], command['files'])
+
+        if max_queries_per_file and command['files'] \
+                and command['queries'] > max_queries_per_file * command['files']:
+            logger.warning('%s issued %d queries for %d files, which exceeds %s queries per file', name,
+                           command['queries'], command['files'], max_queries_per_file)
+
+    def record_query(self, statement, rows, duration):
+        shape = get_query_shape(statement)
+        with self.lock:
+            query = self.queries.setdefault(shape, {'calls': 0, 'rows': 0, 'time': 0.0})
+            query['calls'] += 1
+            query['rows'] += max(rows, 0)
+            query['time'] += duration
+
+    def record_files(self, files):
+        self.files = max(self.files, files)
+
+    def count_queries(self):
+        return (
+            sum(query['calls'] for query in self.queries.values()),
+            sum(query['rows'] for query in self.queries.values()),
+            sum(query['time'] for query in self.queries.values())
+        )
+
+    def get_results(self):
+        total = time.perf_counter() - self.start
+        return {
+            'created': datetime.now().isoformat(),
+            'total': total,
+            'spans': {
+                name: {
+                    'calls': span['calls'],
+                    'time': span['time'],
+                    'mean': span['time'] / span['calls'],
+                    'percent': 100.0 * span['time'] / total if total else 0.0
+                } for name, span in self.spans.items()
+            },
+            'commands': self.commands,
+            'queries': self.queries
+        }
+
+    def report(self, profile_file):
+        results = self.get_results()
+
+        # the table goes to stderr, so that the output of the list_* commands is not affected
+        print(f'{"span":<20} {"calls":>10} {"time [s]":>12} {"mean [s]":>12} {"%":>7}', file=sys.stderr)
+        for name, span in sorted(results['spans'].items(), key=lambda item: -item[1]['time']):
+            print(f'{name:<20} {span["calls"]:>10} {span["time"]:>12.4f} {span["mean"]:>12.6f} '
+                  f'{span["percent"]:>7.2f}', file=sys.stderr)
+        print(f'{"total":<20} {"":>10} {results["total"]:>12.4f}', file=sys.stderr)
+
+        if self.queries:
+            print(file=sys.stderr)
+            print(f'{"queries":>10} {"rows":>10} {"time [s]":>12}  statement', file=sys.stderr)
+            for shape, query in sorted(self.queries.items(), key=lambda item: -item[1]['time'])[:10]:
+                print(f'{query["calls"]:>10} {query["rows"]:>10} {query["time"]:>12.4f}  {shape[:80]}',
+                      file=sys.stderr)
+
+        profile_path = Path(profile_file)
+        logger.info('write profile %s', profile_path)
+        profile_path.write_text(json.dumps(results, indent=2))
+
+        if self.cprofile is not None and self.stage in self.spans:
+            cprofile_path = profile_path.with_suffix(f'.{self.stage}.prof')
+            logger.info('write cprofile %s', cprofile_path)
+            self.cprofile.dump_stats(cprofile_path)
+
+
+def get_query_shape(statement):
+    # replace the parameters, so that the same query with different values has the same shape
+    shape = parameter_pattern.sub('?', statement)
+    shape = parameter_list_pattern.sub('?, ...', shape)
+    return whitespace_pattern.sub(' ', shape).strip()
+
+
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            with profiler.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+profiler = Profiler()
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
+from isimip_utils.exceptions import FetchError
+
+logger = logging.getLogger(__name__)
+
+
+def get_protocol_locations(path, protocol_locations, sub_location, cache_dir=None, ttl=3600, offline=False):
+    # replace the protocol urls by local copies in the cache directory, which can be used
+    # as protocol locations by isimip_utils.protocol, like isimip_utils.protocol the first
+    # location which has a json file for the path is used, so the remaining urls are not fetched
+    if cache_dir is None:
+        return protocol_locations
+
+    locations = []
+    for protocol_location in protocol_locations:
+        found = False
+        if not isinstance(protocol_location, Path) and urlparse(protocol_location).scheme:
+            location_hash = hashlib.sha256(protocol_location.encode()).hexdigest()[:16]
+            cache_location = Path(cache_dir).expanduser() / location_hash
+
+            for json_path in get_json_paths(path):
+                url = f'{protocol_location}/{sub_location}/{json_path.as_posix()}'
+                if cache_json(url, cache_location / 'output' / sub_location / json_path, ttl, offline):
+                    found = True
+                    break
+
+            locations.append(cache_location)
+        else:
+            found = any((Path(protocol_location) / 'output' / sub_location / json_path).is_file()
+                        for json_path in get_json_paths(path))
+            locations.append(protocol_location)
+
+        if found:
+            break
+
+    return locations
+
+
+def get_json_paths(path):
+    # the same candidates as in isimip_utils.protocol.find_json, without duplicates
+    path_components = Path(path).parts
+    return list(dict.fromkeys(
+        Path(os.sep.join(path_components[:i + 1])).with_suffix('.json')
+        for i in range(len(path_components), 0, -1)
+    ))
+
+
+def cache_json(url, cache_path, ttl=3600, offline=False):
+    # fetch the json file at url into cache_path, unless it was fetched less than ttl seconds ago,
+    # stale files are revalidated using the ETag and Last-Modified headers of the previous response,
+    # missing files (e.g. 404) are cached as well, returns True if the file exists
+    meta_path = cache_path.with_name(f'.{cache_path.name}.meta')
+    try:
+        meta = json.loads(meta_path.read_text())
+    except FileNotFoundError:
+        meta = {}
+
+    if offline:
+        if not meta:
+            logger.warning('%s is not cached', url)
+        return cache_path.exists()
+
+    if meta and time.time() - meta['fetched'] < ttl:
+        return cache_path.exists()
+
+    headers = {}
+    if cache_path.exists():
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    logger.debug('url = %s', url)
+    try:
+        response = requests.get(url, headers=headers)
+    except requests.exceptions.ConnectionError as e:
+        if meta:
+            logger.warning('%s could not be fetched, using the cached file', url)
+            return cache_path.exists()
+        raise FetchError(url) from e
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if response.status_code == 304:
+        logger.debug('not modified %s', url)
+    elif response.status_code == 200:
+        tmp_path = cache_path.with_name(f'.{cache_path.name}.{os.getpid()}.tmp')
+        tmp_path.write_bytes(response.content)
+        os.replace(tmp_path, cache_path)
+    else:
+        cache_path.unlink(missing_ok=True)
+
+    meta_path.write_text(json.dumps({
+        'url': url,
+        'status_code': response.status_code,
+        'etag': response.headers.get('ETag', meta.get('etag')),
+        'last_modified': response.headers.get('Last-Modified', meta.get('last_modified')),
+        'fetched': time.time()
+    }))
+
+    return cache_path.exists()
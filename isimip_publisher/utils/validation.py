@@ -1,11 +1,24 @@
 import json
 import logging
+import math
+import random
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import jsonschema
 from isimip_utils.checksum import get_checksum
 
+from .files import read_netcdf_headers
+from .profiling import profiler, timed
+
 logger = logging.getLogger(__name__)
 
+# compiled validators and the valid specifiers for each schema, keyed by the id of the schema,
+# the schema is stored as well, so that the id is not reused
+validators = {}
+
+
+@timed('validation')
 def validate_datasets(schema, path, datasets):
     if not datasets:
         raise RuntimeError(f'no dataset found for {path}')
@@ -20,80 +33,159 @@ def validate_datasets(schema, path, datasets):
             file.validate(schema)
 
 
-def check_datasets(datasets, db_datasets, skip_checksum=False):
-    if len(datasets) != len(db_datasets):
-        logger.error(f'Length mismatch {len(datasets)} != {len(db_datasets)}')
-
-    for dataset, db_dataset in zip(datasets, db_datasets, strict=True):
-        for file, db_file in zip(dataset.files, db_dataset.files, strict=True):
-            # check the actual file
-            file_path = Path(file.abspath)
-            if file_path.is_file():
-                if not skip_checksum:
-                    # compute the checksum
-                    computed_checksum = get_checksum(file.abspath, file.checksum_type)
-
-                    # check file checksum consistency
-                    if computed_checksum == db_file.checksum:
-                        logger.info(f'Checksum match for file {db_file.path}')
-                    else:
-                        logger.error(f'Checksum mismatch {file.checksum} != {computed_checksum} '
-                                     f'for file {db_file.path}')
-
-                # check file path consistency
-                if file.path != db_file.path:
-                    logger.error(f'Path mismatch {file.path} != {db_file.path} for file {db_file.path}')
-
-                # check file uuid consistency
-                if file.uuid:
-                    db_uuid = db_file.target_id or db_file.id
-                    if str(file.uuid) != str(db_uuid):
-                        logger.error(f'UUID mismatch {file.uuid} != {db_uuid} for file {db_file.path}')
-
-                # check file specifiers consistency
-                if file.specifiers != db_file.specifiers:
-                    logger.error(f'Specifier mismatch {format_json(file.specifiers)} !='
-                                 f' {format_json(db_file.specifiers)} for file {db_file.path}')
-            else:
-                logger.error(f'{file_path} does not exist')
-
-            # check the json file
-            if file_path.with_suffix('.json').is_file():
-                # open json file
-                metadata = json.loads(file_path.with_suffix('.json').read_text())
-
-                # check json checksum consistency
-                if metadata.get('checksum') != db_file.checksum:
-                    logger.error(f"JSON checksum mismatch {metadata.get('checksum')} != {db_file.checksum}"
-                                 f' for file {db_file.path}')
-
-                # check json path consistency
-                if metadata.get('path') != db_file.path:
-                    logger.error(f"JSON path mismatch {metadata.get('path')} != {db_file.path} "
-                                 f' for file {db_file.path}')
-
-                # check json uuid consistency
-                if metadata.get('id'):
-                    db_uuid = db_file.target_id or db_file.id
-                    if metadata.get('id') != str(db_uuid):
-                        logger.error(f"JSON mismatch {metadata.get('id')} != {db_uuid} for file {db_file.path}")
-
-                # check json specifiers consistency
-                if metadata.get('specifiers') != db_file.specifiers:
-                    logger.error(f"JSON specifier mismatch {format_json(metadata.get('specifiers'))} !="
-                                 f' {format_json(db_file.specifiers)} for file {db_file.path}')
-            else:
-                logger.error(f'{file_path} does not exist')
+def get_validator(schema):
+    # check the schema and compile the validator only once per schema
+    if id(schema) not in validators:
+        validator_class = jsonschema.validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        validators[id(schema)] = (schema, validator_class(schema), set())
+
+    _, validator, valid = validators[id(schema)]
+    return validator, valid
+
+
+def validate_specifiers(schema, specifiers):
+    # most files of a dataset share the same specifiers (apart from the years),
+    # therefore valid specifiers are remembered and only validated once, the type is part
+    # of the key, since True, 1 and 1.0 are equal, but not for the schema (e.g. integer vs boolean)
+    validator, valid = get_validator(schema)
+    try:
+        key = frozenset((identifier, type(value), value) for identifier, value in specifiers.items())
+    except TypeError:
+        key = None  # unhashable values, e.g. lists
 
-        # check dataset
-        if dataset.path != db_dataset.path:
-            logger.error(f'Path mismatch {dataset.path} != {db_dataset.path} for dataset {db_dataset.id}')
+    if key is None or key not in valid:
+        error = jsonschema.exceptions.best_match(validator.iter_errors({'specifiers': specifiers}))
+        if error is not None:
+            raise error
+        if key is not None:
+            valid.add(key)
+
+
+def check_datasets(datasets, db_datasets, skip_checksum=False, sample=None, since=None, workers=None):
+    # join the datasets from the file system and the datasets from the database by their path
+    dataset_dict = {dataset.path: dataset for dataset in datasets}
+    db_dataset_dict = {db_dataset.path: db_dataset for db_dataset in db_datasets}
+
+    for dataset_path in sorted(dataset_dict.keys() - db_dataset_dict.keys()):
+        logger.error(f'Dataset {dataset_path} is not in the database')
+
+    for dataset_path in sorted(db_dataset_dict.keys() - dataset_dict.keys()):
+        logger.error(f'Dataset {dataset_path} is not on the file system')
+
+    file_pairs = []
+    for dataset_path in sorted(dataset_dict.keys() & db_dataset_dict.keys()):
+        dataset, db_dataset = dataset_dict[dataset_path], db_dataset_dict[dataset_path]
 
         # check if the specifiers match
         if dict(dataset.specifiers) != dict(db_dataset.specifiers):
             logger.error(f'Specifier mismatch {format_json(dataset.specifiers)} !='
                          f' {format_json(db_dataset.specifiers)} for dataset {db_dataset.id}')
 
+        # a dataset link needs to have the same digest as its target dataset
+        if db_dataset.target is not None and db_dataset.digest and db_dataset.target.digest \
+                and db_dataset.digest != db_dataset.target.digest:
+            logger.error(f'Digest mismatch {db_dataset.digest} != {db_dataset.target.digest}'
+                         f' for dataset link {db_dataset.path}')
+
+        # join the files of the dataset by their path as well
+        file_dict = {file.path: file for file in dataset.files}
+        db_file_dict = {db_file.path: db_file for db_file in db_dataset.files}
+
+        for file_path in sorted(file_dict.keys() - db_file_dict.keys()):
+            logger.error(f'File {file_path} is not in the database')
+
+        for file_path in sorted(db_file_dict.keys() - file_dict.keys()):
+            logger.error(f'File {file_path} is not on the file system')
+
+        for file_path in sorted(file_dict.keys() & db_file_dict.keys()):
+            file_pairs.append((file_dict[file_path], db_file_dict[file_path]))
+
+    # skip files which were not modified since the given date, missing files are always checked,
+    # the timestamps are compared, so that since can be naive (local time) or timezone aware
+    if since is not None:
+        since_timestamp = since.timestamp()
+        file_pairs = [(file, db_file) for file, db_file in file_pairs
+                      if get_mtime(file.abspath, since_timestamp) >= since_timestamp]
+
+    # check only a random sample of the files
+    if sample is not None:
+        k = min(len(file_pairs), math.ceil(sample * len(file_pairs)))
+        file_pairs = [file_pairs[i] for i in sorted(random.sample(range(len(file_pairs)), k))]
+
+    # the headers (for the uuid) are read upfront using processes, since netCDF4/HDF5 is not thread-safe,
+    # the checksums and the json files are checked in parallel threads
+    read_netcdf_headers([file for file, _ in file_pairs if Path(file.abspath).is_file()], workers=workers)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(lambda file_pair: check_file(*file_pair, skip_checksum), file_pairs):
+            pass
+
+
+def check_file(file, db_file, skip_checksum=False):
+    # check the actual file
+    file_path = Path(file.abspath)
+    if file_path.is_file():
+        if not skip_checksum:
+            # compute the checksum
+            with profiler.span('checksum'):
+                computed_checksum = get_checksum(file.abspath, file.checksum_type)
+
+            # check file checksum consistency
+            if computed_checksum == db_file.checksum:
+                logger.info(f'Checksum match for file {db_file.path}')
+            else:
+                logger.error(f'Checksum mismatch {db_file.checksum} != {computed_checksum} '
+                             f'for file {db_file.path}')
+
+        # check file uuid consistency
+        if file.uuid:
+            db_uuid = db_file.target_id or db_file.id
+            if str(file.uuid) != str(db_uuid):
+                logger.error(f'UUID mismatch {file.uuid} != {db_uuid} for file {db_file.path}')
+
+        # check file specifiers consistency
+        if file.specifiers != db_file.specifiers:
+            logger.error(f'Specifier mismatch {format_json(file.specifiers)} !='
+                         f' {format_json(db_file.specifiers)} for file {db_file.path}')
+    else:
+        logger.error(f'{file_path} does not exist')
+
+    # check the json file
+    if file_path.with_suffix('.json').is_file():
+        # open json file
+        metadata = json.loads(file_path.with_suffix('.json').read_text())
+
+        # check json checksum consistency
+        if metadata.get('checksum') != db_file.checksum:
+            logger.error(f"JSON checksum mismatch {metadata.get('checksum')} != {db_file.checksum}"
+                         f' for file {db_file.path}')
+
+        # check json path consistency
+        if metadata.get('path') != db_file.path:
+            logger.error(f"JSON path mismatch {metadata.get('path')} != {db_file.path} "
+                         f' for file {db_file.path}')
+
+        # check json uuid consistency
+        if metadata.get('id'):
+            db_uuid = db_file.target_id or db_file.id
+            if metadata.get('id') != str(db_uuid):
+                logger.error(f"JSON mismatch {metadata.get('id')} != {db_uuid} for file {db_file.path}")
+
+        # check json specifiers consistency
+        if metadata.get('specifiers') != db_file.specifiers:
+            logger.error(f"JSON specifier mismatch {format_json(metadata.get('specifiers'))} !="
+                         f' {format_json(db_file.specifiers)} for file {db_file.path}')
+    else:
+        logger.error(f'{file_path} does not exist')
+
+
+def get_mtime(abspath, default=None):
+    try:
+        return Path(abspath).stat().st_mtime
+    except FileNotFoundError:
+        return default
+
 
 def format_json(data):
     return json.dumps({key: data[key] for key in sorted(data.keys())}, indent=2)